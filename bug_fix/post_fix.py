@@ -9,11 +9,13 @@ import argparse
 import copy
 import json
 import os
-import sqlite3
 import time
+from contextlib import closing
 from typing import List
 from rapidfuzz import fuzz
 
+from db_exec import ExecTimeout, connections, fetch, time_budget
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -37,11 +39,12 @@ class BugFix:
     FUN_CALL_NUMBER = "wrong number of arguments to function "
 
 
-    def __init__(self, db_dir: str, ins_list=None, patience: int = 5, verbose: int = False):
+    def __init__(self, db_dir: str, ins_list=None, patience: int = 5, verbose: int = False, timeout: float = 60.):
         if ins_list is None:
             ins_list = []
         self.db_dir = db_dir
         self.patience = patience
+        self.timeout = timeout
         self.fix_pass = 0
         self.fix_fail = 0
         self.fail_reason = []
@@ -72,14 +75,18 @@ class BugFix:
         has_bug = True
         while has_bug and p > 0:
             try:
-                conn = sqlite3.connect(db_path)
-                conn.text_factory = bytes
-                c = conn.cursor()
-                c.execute(sql)
-                c.fetchall()
+                conn = connections.get(db_path, bytes)
+                with closing(conn.cursor()) as c, time_budget(conn, self.timeout):
+                    c.execute(sql)
+                    # Only whether it runs matters, stop at the first row
+                    fetch(c, exists_only=True)
                 has_bug = False
                 if p < self.patience:
                     self.fix_pass += 1
+            except ExecTimeout as e:
+                # It runs, only too slowly, no error to fix
+                self.fail_reason.append(str(e))
+                break
             except Exception as e:
                 error_msg = str(e)
                 if sql.endswith(";"):
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 21:00
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : __init__.py.py
+# @Software: PyCharm
+from db_exec.executor import ExecTimeout, execute, fetch, time_budget
+from db_exec.pool import ConnectionManager, connections, decode_ignore
+from db_exec.replica import ReplicaLoader, enable_replicas
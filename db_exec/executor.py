@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 21:00
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : executor.py
+# @Software: PyCharm
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, List, Tuple
+
+# VM instructions between two budget checks
+PROGRESS_STEPS = 1000
+# Rows pulled from SQLite at a time
+FETCH_BATCH = 1024
+
+
+class ExecTimeout(TimeoutError):
+    """The query ran past its time or VM instruction budget and was interrupted."""
+
+
+@contextmanager
+def time_budget(connection: sqlite3.Connection, timeout: float = 0., max_steps: int = 0):
+    """Interrupt the statements run on `connection` inside the block once they took over `timeout`
+    seconds or `max_steps` VM instructions, raising ExecTimeout. 0 disables a limit."""
+    if not timeout and not max_steps:
+        yield
+        return
+    deadline = time.monotonic() + timeout if timeout else None
+    state = {"steps": 0, "reason": ""}
+
+    def check():
+        # A non zero return makes SQLite abort the running statement
+        state["steps"] += PROGRESS_STEPS
+        if deadline is not None and time.monotonic() > deadline:
+            state["reason"] = f"{timeout}s"
+        elif max_steps and state["steps"] > max_steps:
+            state["reason"] = f"{max_steps} VM instructions"
+        return 1 if state["reason"] else 0
+
+    connection.set_progress_handler(check, PROGRESS_STEPS)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if state["reason"]:
+            raise ExecTimeout(f"Query interrupted after {state['reason']}") from e
+        raise
+    finally:
+        connection.set_progress_handler(None, PROGRESS_STEPS)
+
+
+def row_bytes(rows: List[Tuple]) -> int:
+    """Rough memory of the values of `rows`, text and blobs by their length and 8 bytes for the others."""
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for row in rows for v in row)
+
+
+def fetch(cursor: sqlite3.Cursor, max_rows: int = 0, max_bytes: int = 0, exists_only: bool = False
+          ) -> Tuple[List[Tuple], bool]:
+    """Stream the rows of an executed cursor by fetchmany, stopping at `max_rows` rows or `max_bytes`
+    bytes of values (0 for no limit). Return the rows and whether they overflowed a cap.
+
+    With `exists_only`, stop at the first row, e.g. to check that a query runs.
+    """
+    if exists_only:
+        row = cursor.fetchone()
+        return ([row] if row is not None else []), False
+    rows = []
+    size = 0
+    while True:
+        batch = cursor.fetchmany(FETCH_BATCH)
+        if not batch:
+            return rows, False
+        rows += batch
+        if max_bytes:
+            size += row_bytes(batch)
+        if (max_rows and len(rows) > max_rows) or (max_bytes and size > max_bytes):
+            return rows[:max_rows] if max_rows else rows, True
+
+
+def execute(connection: sqlite3.Connection, query: str, timeout: float = 0., max_steps: int = 0,
+            max_rows: int = 0, max_bytes: int = 0, exists_only: bool = False) -> Tuple[str, Any]:
+    """Run `query` within the budget and fetch its rows within the caps.
+
+    Return ("result", rows), ("overflow", the rows up to a cap) when the result is larger than
+    the caps, or ("exception", error) with an ExecTimeout error when it was interrupted.
+    """
+    cursor = connection.cursor()
+    try:
+        with time_budget(connection, timeout, max_steps):
+            cursor.execute(query)
+            rows, overflow = fetch(cursor, max_rows, max_bytes, exists_only)
+        return ("overflow" if overflow else "result"), rows
+    except Exception as e:
+        return "exception", e
+    finally:
+        cursor.close()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 21:40
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : pool.py
+# @Software: PyCharm
+import atexit
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.request import pathname2url
+
+
+def decode_ignore(b: bytes) -> str:
+    return b.decode(errors="ignore")
+
+
+class ConnectionManager:
+    """Read-only SQLite connections, opened once per database, thread and process and then reused.
+
+    A connection is only handed to the thread that opened it. Each thread keeps its `max_open`
+    most recently used ones, e.g. over the many databases of a test suite. Databases are opened
+    `immutable` by default: SQLite then skips locking and change detection, so the files must
+    not be written while in use. With `replicas` set (see db_exec.replica), connections are to
+    in memory copies of the databases instead. A copy is made once per process and shared by its
+    threads; it stays loaded when the connections of a thread are evicted.
+    """
+
+    def __init__(self, immutable: bool = True, mmap_size: int = 256 << 20, cache_size: int = -65536,
+                 max_open: int = 64):
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size  # Negative for KiB
+        self.max_open = max_open
+        self.replicas = None
+        self._reset()
+        atexit.register(self.close_all)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The connections of the parent process are dropped, never used or closed in a child. The lock may
+        # have been held by another thread of the parent at the fork, the child gets a new one
+        self._lock = threading.Lock()
+        self._replica_lock = threading.Lock()
+        self._local = threading.local()
+        self._open: List[sqlite3.Connection] = []
+        # URI and keep-alive connection of the replica of every database loaded by this process
+        self._replicas: Dict[str, Tuple[str, sqlite3.Connection]] = {}
+
+    def _open_uri(self, uri: str) -> sqlite3.Connection:
+        # Closed by close_all from any thread, otherwise only used by its own thread
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        connection.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        return connection
+
+    def _replica_uri(self, sqlite_path: str) -> str:
+        """URI of the replica of the database, loaded by the first thread asking for it."""
+        key = os.path.abspath(sqlite_path)
+        loaded = self._replicas.get(key)
+        if loaded is not None:
+            return loaded[0]
+        with self._replica_lock:
+            if key not in self._replicas:
+                uri = f"file:replica_{os.getpid()}_{id(self)}_{len(self._replicas)}?mode=memory&cache=shared"
+                source = self._open_uri(self._file_uri(sqlite_path))
+                try:
+                    self._replicas[key] = uri, self.replicas.load(sqlite_path, source, uri)
+                finally:
+                    source.close()
+            return self._replicas[key][0]
+
+    def _file_uri(self, sqlite_path: str) -> str:
+        uri = f"file:{pathname2url(os.path.abspath(sqlite_path))}?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        return uri
+
+    def _connect(self, sqlite_path: str) -> sqlite3.Connection:
+        if self.replicas is not None:
+            return self.replicas.protect(self._open_uri(self._replica_uri(sqlite_path)))
+        return self._open_uri(self._file_uri(sqlite_path))
+
+    def get(self, sqlite_path: str, text_factory: Optional[Callable] = str) -> sqlite3.Connection:
+        """The connection of this thread to the database, with `text_factory` set."""
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = OrderedDict()
+        key = os.path.abspath(sqlite_path)
+        connection = connections.get(key)
+        if connection is None:
+            connection = connections[key] = self._connect(sqlite_path)
+            with self._lock:
+                self._open.append(connection)
+            while len(connections) > self.max_open:
+                self._close(connections.popitem(last=False)[1])
+        else:
+            connections.move_to_end(key)
+        connection.text_factory = text_factory
+        return connection
+
+    @contextmanager
+    def cursor(self, sqlite_path: str, text_factory: Optional[Callable] = str):
+        cursor = self.get(sqlite_path, text_factory).cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def _close(self, connection: sqlite3.Connection):
+        with self._lock:
+            if connection in self._open:
+                self._open.remove(connection)
+        connection.close()
+
+    def close_all(self):
+        """Close the connections of every thread and drop the replicas, they are opened again on the next use."""
+        with self._lock:
+            opened, self._open = self._open, []
+        with self._replica_lock:
+            opened += [replica for _, replica in self._replicas.values()]
+            self._replicas = {}
+        for connection in opened:
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+# Shared by every module of the process
+connections = ConnectionManager()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 22:10
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : replica.py
+# @Software: PyCharm
+import json
+import os
+import sqlite3
+from typing import Dict, List, Tuple
+
+from db_exec.pool import ConnectionManager, connections
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def keep_query_only(action: int, arg1, arg2, db_name, trigger) -> int:
+    """Authorizer refusing to switch `PRAGMA query_only` off again."""
+    if action == sqlite3.SQLITE_PRAGMA and (arg1 or "").lower() == "query_only" and arg2 is not None:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+class ReplicaLoader:
+    """In memory copies of the databases, with indexes on their primary and foreign key columns.
+
+    The key columns come from the schemas of `tables_file`, keyed by db_id, i.e. the directory
+    of the database file. Databases without a schema there use the keys declared in the file.
+    The files on disk are only read and the replicas refuse writes as well. A replica is a shared
+    cache in memory database, so every connection to its URI in the process reads the same copy.
+    """
+
+    def __init__(self, tables_file: str = ""):
+        self.keys: Dict[str, List[Tuple[str, str]]] = {}
+        if tables_file:
+            with open(tables_file, 'r') as f:
+                for schema in json.load(f):
+                    self.keys[schema['db_id']] = self.schema_keys(schema)
+
+    @staticmethod
+    def schema_keys(schema: Dict) -> List[Tuple[str, str]]:
+        """(table, column) of the primary and foreign keys of a tables.json schema."""
+        tables = schema['table_names_original']
+        columns = schema['column_names_original']
+        idx_list = []
+        for pk in schema['primary_keys']:
+            idx_list += pk if isinstance(pk, list) else [pk]
+        for source, target in schema['foreign_keys']:
+            idx_list += [source, target]
+        keys = {(tables[columns[i][0]], columns[i][1]) for i in idx_list if columns[i][0] >= 0}
+        return sorted(keys)
+
+    @staticmethod
+    def declared_keys(connection: sqlite3.Connection) -> List[Tuple[str, str]]:
+        """(table, column) of the primary and foreign keys declared in the database."""
+        keys = set()
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            for _, column, _, _, _, pk in connection.execute(f"PRAGMA table_info({quote(table)})"):
+                if pk:
+                    keys.add((table, column))
+            for fk in connection.execute(f"PRAGMA foreign_key_list({quote(table)})"):
+                keys.add((table, fk[3]))
+                if fk[4]:
+                    keys.add((fk[2], fk[4]))
+        return sorted(keys)
+
+    @staticmethod
+    def protect(connection: sqlite3.Connection) -> sqlite3.Connection:
+        """Make a connection to a replica read-only, like the files."""
+        connection.execute("PRAGMA query_only = ON")
+        connection.set_authorizer(keep_query_only)
+        return connection
+
+    def load(self, sqlite_path: str, source: sqlite3.Connection, uri: str) -> sqlite3.Connection:
+        """Copy the database of `source` to the in memory database `uri` by the backup API and index
+        its key columns. The returned connection keeps the replica alive until it is closed."""
+        replica = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source.backup(replica)
+        db_id = os.path.basename(os.path.dirname(os.path.abspath(sqlite_path)))
+        keys = self.keys[db_id] if db_id in self.keys else self.declared_keys(replica)
+        for n, (table, column) in enumerate(keys):
+            try:
+                replica.execute(f"CREATE INDEX IF NOT EXISTS replica_key_{n} ON {quote(table)} ({quote(column)})")
+            except sqlite3.Error:
+                # tables.json may name a column or table the file lacks
+                pass
+        # A sampled DELETE or DROP must fail instead of changing later results
+        return self.protect(replica)
+
+
+def enable_replicas(tables_file: str = "", manager: ConnectionManager = connections):
+    """Execute on in memory replicas from now on, e.g. in every worker process of a run."""
+    manager.close_all()
+    manager.replicas = ReplicaLoader(tables_file)
@@ -25,8 +25,13 @@ import sqlite3
 import traceback
 import argparse
 
+from db_exec import connections, fetch, time_budget
 from .process_sql import tokenize, get_schema, get_tables_with_alias, Schema, get_sql
 
+# Seconds a predicted query may run before it counts as wrong
+EXEC_TIMEOUT = 60
+# Rows fetched of a predicted result, all of them when the gold has more
+EXEC_MAX_ROWS = 100000
 # Flag to disable value evaluation
 DISABLE_VALUE = True
 # Flag to disable distinct in select evaluation
@@ -837,16 +842,29 @@ def eval_exec_match(db, p_str, g_str, pred, gold):
     return 1 if the values between prediction and gold are matching
     in the corresponding index. Currently not support multiple col_unit(pairs).
     """
-    conn = sqlite3.connect(db)
+    conn = connections.get(db)
     cursor = conn.cursor()
+
+    def exec_pred(max_rows):
+        with time_budget(conn, EXEC_TIMEOUT):
+            cursor.execute(p_str)
+            return fetch(cursor, max_rows)
+
     try:
-        cursor.execute(p_str)
-        p_res = cursor.fetchall()
+        p_res, overflow = exec_pred(EXEC_MAX_ROWS)
     except:
         return False
 
     cursor.execute(g_str)
     q_res = cursor.fetchall()
+    if overflow:
+        # Only a gold over the cap can match a prediction over it
+        if len(q_res) <= EXEC_MAX_ROWS:
+            return False
+        try:
+            p_res, _ = exec_pred(0)
+        except:
+            return False
 
     def res_map(res, val_units):
         rmap = {}
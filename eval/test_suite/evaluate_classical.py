@@ -2,7 +2,7 @@ import argparse
 from typing import List, Dict, Any, Tuple
 import pickle as pkl
 import tqdm
-from .exec_eval import exec_on_db, result_eq
+from .exec_eval import exec_on_db, result_eq, pred_caps
 import os
 from collections import defaultdict
 import time
@@ -66,7 +66,9 @@ def judge(args: Tuple[Dict[str, Any], str, bool]) -> bool:
         if flg != "result":
             print("Warning: executing gold query results in an exception")
             continue
-        flg, pred_result = exec_on_db(testcase_path, pred, timeout=int(timeout))
+        max_rows, max_bytes = pred_caps(gold_result)
+        flg, pred_result = exec_on_db(testcase_path, pred, timeout=int(timeout), max_rows=max_rows,
+                                      max_bytes=max_bytes)
         if flg != "result":
             pass_all_testcase = False
             break
@@ -1,7 +1,6 @@
 import os
 import re
 import sqlite3
-import asyncio
 import threading
 from typing import Tuple, Any, List, Set
 from itertools import product
@@ -13,11 +12,16 @@ import pickle as pkl
 import subprocess
 from itertools import chain
 
+from db_exec import connections, decode_ignore, execute
+from db_exec.executor import row_bytes
 from .parse import get_all_preds_for_execution, remove_distinct
 
 
 threadLock = threading.Lock()
 TIMEOUT = 6
+# Caps of a predicted result, lifted when the gold result is over them
+PRED_MAX_ROWS = 100000
+PRED_MAX_BYTES = 64 << 20
 EXEC_TMP_DIR = os.path.join(os.path.dirname(__file__), "tmp")
 
 
@@ -129,43 +133,26 @@ def replace_cur_year(query: str) -> str:
     )
 
 
-# get the database cursor for a sqlite database path
-def get_cursor_from_path(sqlite_path: str):
-    try:
-        if not os.path.exists(sqlite_path):
-            print("Openning a new connection %s" % sqlite_path)
-        connection = sqlite3.connect(sqlite_path)
-    except Exception as e:
-        print(sqlite_path)
-        raise e
-    connection.text_factory = lambda b: b.decode(errors="ignore")
-    cursor = connection.cursor()
-    return cursor
-
-
-async def exec_on_db_(sqlite_path: str, query: str) -> Tuple[str, Any]:
+def exec_on_db(
+    sqlite_path: str, query: str, process_id: str = "", timeout: float = TIMEOUT, max_steps: int = 0,
+    max_rows: int = 0, max_bytes: int = 0
+) -> Tuple[str, Any]:
+    # The budget interrupts the query inside SQLite, ("exception", ExecTimeout) once over it,
+    # ("overflow", rows) for a result over the caps
     query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
     try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
-        return "result", result
+        connection = connections.get(sqlite_path, decode_ignore)
     except Exception as e:
-        cursor.close()
-        cursor.connection.close()
         return "exception", e
+    return execute(connection, query, timeout, max_steps, max_rows, max_bytes)
 
-async def exec_on_db(
-    sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT
-) -> Tuple[str, Any]:
-    try:
-        return await asyncio.wait_for(exec_on_db_(sqlite_path, query), timeout)
-    except asyncio.TimeoutError:
-        return ('exception', TimeoutError)
-    except Exception as e:
-        return ("exception", e)
+
+def pred_caps(gold_result: List[Tuple]) -> Tuple[int, int]:
+    """(max_rows, max_bytes) of the prediction. Under the caps, a prediction over them can not equal
+    the gold and is wrong; a gold over them lifts the caps."""
+    if len(gold_result) > PRED_MAX_ROWS or row_bytes(gold_result) > PRED_MAX_BYTES:
+        return 0, 0
+    return PRED_MAX_ROWS, PRED_MAX_BYTES
 
 
 # postprocess the model predictions to avoid execution errors
@@ -237,16 +224,19 @@ def eval_exec_match(
             ranger = db_paths
 
         for db_path in ranger:
-            g_flag, g_denotation = asyncio.run(exec_on_db(db_path, g_str))
-            p_flag, p_denotation = asyncio.run(exec_on_db(db_path, pred))
+            # The gold is trusted to finish, only the prediction gets the time budget
+            g_flag, g_denotation = exec_on_db(db_path, g_str, timeout=0)
 
             # we should expect the gold to be succesfully executed on the database
             assert (
                 g_flag != "exception"
             ), f"gold query {g_str} has error {g_denotation} on database file {db_path}"
 
-            # wrong if execution fails
-            if p_flag == "exception":
+            max_rows, max_bytes = pred_caps(g_denotation)
+            p_flag, p_denotation = exec_on_db(db_path, pred, max_rows=max_rows, max_bytes=max_bytes)
+
+            # wrong if execution fails or returns more than the gold
+            if p_flag != "result":
                 pred_passes = 0
 
             # if denotations are not equivalent, the prediction must be wrong
@@ -6,16 +6,28 @@
 # @Software: PyCharm
 import torch
 
-from llms.openai import Openai
+from llms.cache import ResponseCache
+from llms.mock import MockLLM
+from llms.openai import Openai, AsyncOpenai
 
 
 def model_init(model_name: str, **kwargs):
+    cache_mode = kwargs.pop("cache_mode", "off")
+    cache_dir = kwargs.pop("cache_dir", "")
+    cache_max_mb = kwargs.pop("cache_max_mb", 0)
+    if cache_mode != "off":
+        kwargs["cache"] = ResponseCache(cache_dir, mode=cache_mode, max_bytes=cache_max_mb * 1024 * 1024)
+
     if "llama" in model_name.lower():
         pass
         # with torch.no_grad():
         #     return LLAMA(model_name, **kwargs)
     elif model_name in Openai.models:
+        if kwargs.get("max_in_flight", 0) > 0:
+            return AsyncOpenai(model_name, **kwargs)
         return Openai(model_name, **kwargs)
+    elif model_name == "mock":
+        return MockLLM(model_name, **kwargs)
     elif model_name == "moss":
         pass
         # return Moss(model_name, **kwargs)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 10:02
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : cache.py
+# @Software: PyCharm
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+class ResponseCache:
+    """Disk-backed, content-addressed store of raw LLM responses.
+
+    Modes:
+        rw:     read-through and write-through
+        replay: read only, a miss raises `CacheMiss` instead of calling the API
+        write:  always call the API and overwrite the stored response
+    """
+    modes = {'rw', 'replay', 'write'}
+
+    def __init__(self, cache_dir: str, mode: str = 'rw', max_bytes: int = 0):
+        if mode not in self.modes:
+            raise ValueError(f"Can not handle cache mode as '{mode}'")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "responses.sqlite")
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, value TEXT, size INTEGER, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(model: str, prompt: str, n=None, stop=None, temperature=None, max_tokens=None, wave_idx=0) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        fields = [model, prompt_hash, n, stop, temperature, max_tokens]
+        # Later waves of one prompt are distinct samples, the first keeps the key of a plain request
+        if wave_idx:
+            fields.append(wave_idx)
+        request = json.dumps(fields)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        if self.mode == 'write':
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == 'replay':
+                    raise CacheMiss(key)
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, response) -> Dict:
+        """Store the `choices` and `usage` of a response and return them as plain dicts."""
+        value = json.loads(json.dumps({"choices": response["choices"], "usage": response["usage"]}))
+        if self.mode == 'replay':
+            return value
+        data = json.dumps(value)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._size -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, value, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, model, data, len(data), time.time())
+            )
+            self._size += len(data)
+            if self.max_bytes:
+                self._evict()
+            self._conn.commit()
+        return value
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        # Least recently used first, down to 90% of the budget
+        target = int(self.max_bytes * 0.9)
+        while self._size > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= target:
+                    break
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
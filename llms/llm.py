@@ -4,7 +4,19 @@
 # @Email   : httdty2@163.com
 # @File    : llm.py
 # @Software: PyCharm
-from typing import List
+import asyncio
+import queue
+import threading
+from typing import List, Iterable, Iterator, Tuple, Optional, Callable
+
+
+class FailedCompletion(str):
+    """Empty completion of a request given up after its retries."""
+    pass
+
+
+def has_failed(completions: List[str]) -> bool:
+    return any(isinstance(c, FailedCompletion) for c in completions)
 
 
 class LLM:
@@ -17,3 +29,180 @@ class LLM:
 
     def infer(self, prompt: List[str]):
         pass
+
+    @staticmethod
+    def _unpack(item) -> Tuple[str, Optional[int]]:
+        """Inputs are prompts, or instances with a `prompt` and optionally its `prompt_tokens`."""
+        if isinstance(item, dict):
+            return item['prompt'], item.get('prompt_tokens')
+        return item, None
+
+    def infer_stream(self, prompts: Iterable, batch_size: int = 1, wave: int = 0, early_stop: Callable = None,
+                     **kwargs) -> Iterator[Tuple[int, List[str]]]:
+        """Yield `(idx, completions)` for every prompt, `idx` being its position in `prompts`.
+
+        With `wave`, the `n` completions of a prompt are sampled `wave` at a time and
+        `early_stop(idx, new_completions, remaining)` is called after each wave; sampling
+        of the prompt stops once it returns True.
+
+        The default implementation sends `batch_size` prompts at a time through `infer`.
+        """
+        batch = []
+        start = 0
+        for prompt in prompts:
+            batch.append(prompt)
+            if len(batch) == batch_size:
+                yield from enumerate(self._infer_waves(batch, start, wave, early_stop, kwargs), start)
+                start += len(batch)
+                batch = []
+        if batch:
+            yield from enumerate(self._infer_waves(batch, start, wave, early_stop, kwargs), start)
+
+    def _infer_waves(self, batch, start, wave, early_stop, kwargs):
+        if not wave:
+            return self.infer(batch, **kwargs)
+        n = kwargs.get('n') or 1
+        outputs = [[] for _ in batch]
+        active = list(range(len(batch)))
+        wave_idx = 0
+        while active:
+            size = min(wave, min(n - len(outputs[i]) for i in active))
+            still_active = []
+            # The wave index tells the requests of the waves apart, e.g. for the response cache
+            request = {**kwargs, 'n': size, 'wave_idx': wave_idx}
+            wave_idx += 1
+            for i, res in zip(active, self.infer([batch[i] for i in active], **request)):
+                outputs[i] += res
+                remaining = n - len(outputs[i])
+                if has_failed(res):
+                    # The retries are spent already, further waves would only fail again
+                    continue
+                stop = early_stop(start + i, res, remaining) if early_stop else False
+                if remaining > 0 and not stop:
+                    still_active.append(i)
+            active = still_active
+        return outputs
+
+
+class AsyncLLM(LLM):
+    """LLM backend that keeps up to `max_in_flight` requests running across the whole input.
+
+    Sub-classes implement `ainfer_one`; `infer_stream` yields completions in completion order.
+    """
+
+    def __init__(self, name, max_in_flight: int = 32):
+        super().__init__(name)
+        self.max_in_flight = max_in_flight
+
+    async def ainfer_one(self, item, **kwargs) -> List[str]:
+        raise NotImplementedError
+
+    def infer(self, prompt_list, **kwargs):
+        assert isinstance(prompt_list, list), "Please make sure the input is a list of str"
+        res = [None] * len(prompt_list)
+        for idx, output in self.infer_stream(prompt_list, **kwargs):
+            res[idx] = output
+        return res
+
+    def infer_stream(self, prompts: Iterable, batch_size: int = 1, wave: int = 0, early_stop: Callable = None,
+                     **kwargs) -> Iterator[Tuple[int, List[str]]]:
+        # The event loop lives in its own thread so the caller can post-process
+        # finished completions while the next requests are still in flight.
+        finished = queue.Queue()
+        done = object()
+
+        def runner():
+            try:
+                asyncio.run(self._pipeline(prompts, finished, batch_size, wave, early_stop, kwargs))
+            except BaseException as e:
+                finished.put(e)
+            finally:
+                finished.put(done)
+
+        thread = threading.Thread(target=runner, name=f"{self.name}-infer", daemon=True)
+        thread.start()
+        while True:
+            item = finished.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        thread.join()
+
+    async def _sample_waves(self, idx, prompt, wave, early_stop, kwargs):
+        if not wave:
+            return await self.ainfer_one(prompt, **kwargs)
+        loop = asyncio.get_running_loop()
+        n = kwargs.get('n') or 1
+        outputs = []
+        wave_idx = 0
+        while len(outputs) < n:
+            # The wave index tells the requests of the waves apart, e.g. for the response cache
+            res = await self.ainfer_one(prompt, **{**kwargs, 'n': min(wave, n - len(outputs)), 'wave_idx': wave_idx})
+            wave_idx += 1
+            outputs += res
+            # The retries are spent already, further waves would only fail again
+            if has_failed(res):
+                break
+            # The callback may execute SQL, keep it off the event loop
+            if early_stop and await loop.run_in_executor(None, early_stop, idx, res, n - len(outputs)):
+                break
+        return outputs
+
+    async def _pipeline(self, prompts: Iterable, finished: queue.Queue, batch_size: int, wave: int,
+                        early_stop: Callable, kwargs):
+        async def infer_one(idx, prompt):
+            finished.put((idx, await self._sample_waves(idx, prompt, wave, early_stop, kwargs)))
+
+        async def next_prompts():
+            # Building a prompt may block, e.g. on the results of earlier ones, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            it, end = iter(prompts), object()
+            idx = 0
+            while True:
+                prompt = await loop.run_in_executor(None, next, it, end)
+                if prompt is end:
+                    return
+                yield idx, prompt
+                idx += 1
+
+        # Without an in-flight budget, send `batch_size` prompts and wait for all of them
+        if self.max_in_flight <= 0:
+            batch = []
+            async for idx, prompt in next_prompts():
+                batch.append(infer_one(idx, prompt))
+                if len(batch) == batch_size:
+                    await asyncio.gather(*batch)
+                    batch = []
+            if batch:
+                await asyncio.gather(*batch)
+            return
+
+        slots = asyncio.Semaphore(self.max_in_flight)
+        pending = set()
+        errors = []
+
+        async def infer_slot(idx, prompt):
+            try:
+                await infer_one(idx, prompt)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
+
+        async for idx, prompt in next_prompts():
+            await slots.acquire()
+            if errors:
+                break
+            task = asyncio.ensure_future(infer_slot(idx, prompt))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        # A failed request fails the stream, as in the lockstep path, instead of leaving its index out
+        if errors:
+            for task in pending:
+                task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        if errors:
+            raise errors[0]
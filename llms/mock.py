@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 13:05
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : mock.py
+# @Software: PyCharm
+import asyncio
+import hashlib
+import json
+import random
+import threading
+from typing import Dict, List
+
+from llms.llm import AsyncLLM, FailedCompletion
+from llms.rate_limit import RateLimiter, RetryPolicy, TokenBucket
+
+
+class MockServiceError(Exception):
+    """Injected provider failure, retryable like a 5xx answer."""
+    pass
+
+
+class ReplayStore:
+    """Completions of a recorded run, i.e. the `{exp_name}.json` dumped by `models.run`."""
+
+    def __init__(self, replay_file: str, default: str = "SELECT 1"):
+        with open(replay_file, 'r') as f:
+            records = json.load(f)
+        self.records: Dict[str, List[str]] = {}
+        for record in records:
+            if record:
+                self.records[self.key(record['prompt'])] = list(record['raw_result'])
+        self.default = default
+        self.misses = 0
+        self._offsets: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def get(self, prompt: str, n: int = 1) -> List[str]:
+        # Successive requests for one prompt walk through its recorded samples
+        key = self.key(prompt)
+        with self._lock:
+            recorded = self.records.get(key)
+            if not recorded:
+                self.misses += 1
+                return [self.default] * n
+            offset = self._offsets.get(key, 0)
+            self._offsets[key] = offset + n
+        return [recorded[(offset + i) % len(recorded)] for i in range(n)]
+
+
+class LatencyModel:
+    """Latency distribution in seconds, given as `const:s`, `uniform:a,b`, `exp:mean` or `lognormal:mu,sigma`."""
+
+    def __init__(self, spec: str = "const:0"):
+        name, _, params = spec.partition(":")
+        self.name = name
+        self.params = [float(p) for p in params.split(",") if p]
+        if name not in {'const', 'uniform', 'exp', 'lognormal'}:
+            raise ValueError(f"Can not handle latency as '{spec}'")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.name == 'const':
+            return self.params[0] if self.params else 0.
+        elif self.name == 'uniform':
+            return rng.uniform(*self.params)
+        elif self.name == 'exp':
+            return rng.expovariate(1 / self.params[0])
+        else:
+            return rng.lognormvariate(*self.params)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class MockLLM(AsyncLLM):
+    """Offline stand-in for a provider, replaying a recorded run with synthetic latency and failures.
+
+    Every request draws from its own RNG seeded by (seed, prompt, attempt), so a run is
+    reproducible regardless of completion order.
+    """
+
+    def __init__(self, name, replay_file, latency="const:0", error_rate=0., provider_tpm=0, seed=42,
+                 max_in_flight=0, **kwargs):
+        super().__init__(name, max_in_flight=max_in_flight)
+        self.store = ReplayStore(replay_file)
+        self.latency = LatencyModel(latency)
+        self.error_rate = error_rate
+        self.seed = seed
+        # Provider side throughput
+        self.provider = TokenBucket(provider_tpm / 60, max(1., provider_tpm / 60)) if provider_tpm else None
+        # Client side budget and retries, as for the Openai backend
+        self.limiter = RateLimiter.for_model(self.name, kwargs.get('rpm', 0), kwargs.get('tpm', 0))
+        self.retry = RetryPolicy(max_retries=kwargs.get('max_retries', 8), base=0.1, cap=2.)
+        self.errors = 0
+
+    def _rng(self, prompt, attempt):
+        return random.Random(f"{self.seed}:{self.store.key(prompt)}:{attempt}")
+
+    async def _serve(self, prompt, n, attempt):
+        rng = self._rng(prompt, attempt)
+        completions = self.store.get(prompt, n) if rng.random() >= self.error_rate else None
+        tokens = estimate_tokens(prompt) + sum(estimate_tokens(c) for c in completions or [])
+        wait = self.latency.sample(rng)
+        if self.provider:
+            wait += self.provider.reserve(tokens)
+        await asyncio.sleep(wait)
+        if completions is None:
+            self.errors += 1
+            raise MockServiceError("injected provider error")
+        return completions, tokens
+
+    async def ainfer_one(self, item, **kwargs):
+        prompt, prompt_tokens = self._unpack(item)
+        n = kwargs.get('n') or 1
+        estimated = (prompt_tokens or estimate_tokens(prompt)) + 128 * n
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.limiter.reserve(estimated))
+            try:
+                completions, tokens = await self._serve(prompt, n, attempt)
+                break
+            except MockServiceError as e:
+                delay = self.retry.delay(attempt, e)
+                if delay is None:
+                    completions, tokens = [FailedCompletion()], 0
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
+        self.limiter.settle(estimated, tokens)
+        self.count += 1
+        self.prompt_length += prompt_tokens or estimate_tokens(prompt)
+        self.completion_length += sum(estimate_tokens(c) for c in completions)
+        return completions
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 13:40
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : mock_server.py
+# @Software: PyCharm
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llms.mock import ReplayStore, LatencyModel, estimate_tokens
+from llms.rate_limit import TokenBucket
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay_file", type=str, required=True,
+                        help="Recorded run json dumped by models.run")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host")
+    parser.add_argument("--port", type=int, default=8000, help="Port")
+    parser.add_argument("--latency", type=str, default="const:0",
+                        help="Latency distribution, e.g. const:0.5, uniform:0.2,1.5, exp:0.8, lognormal:-0.5,0.6")
+    parser.add_argument("--error_rate", type=float, default=0., help="Rate of injected 503 answers")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before answering 429")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens per minute before answering 429")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+
+    args_ = parser.parse_args()
+    return args_
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Minimal chat-completions / completions endpoint replaying a recorded run."""
+    store: ReplayStore = None
+    latency: LatencyModel = None
+    error_rate = 0.
+    requests: TokenBucket = None
+    tokens: TokenBucket = None
+    rng = random.Random(42)
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message, retry_after=None):
+        headers = {"Retry-After": f"{retry_after:.3f}"} if retry_after is not None else None
+        self._send(status, {"error": {"message": message, "type": "mock_error"}}, headers)
+
+    def do_POST(self):
+        chat = self.path.endswith("/chat/completions")
+        if not chat and not self.path.endswith("/completions"):
+            self._error(404, f"Unknown path {self.path}")
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        prompt = request['messages'][-1]['content'] if chat else request['prompt']
+        n = request.get('n') or 1
+
+        # Quota
+        prompt_tokens = estimate_tokens(prompt)
+        for bucket, amount in ((self.requests, 1), (self.tokens, prompt_tokens)):
+            if bucket:
+                wait = bucket.reserve(amount)
+                if wait > 0:
+                    bucket.refund(amount)
+                    self._error(429, "Rate limit reached", retry_after=wait)
+                    return
+
+        time.sleep(self.latency.sample(self.rng))
+        if self.rng.random() < self.error_rate:
+            self._error(503, "The server is overloaded")
+            return
+
+        completions = self.store.get(prompt, n)
+        if chat:
+            choices = [
+                {"index": i, "message": {"role": "assistant", "content": c}, "finish_reason": "stop"}
+                for i, c in enumerate(completions)
+            ]
+        else:
+            choices = [{"index": i, "text": c, "finish_reason": "stop"} for i, c in enumerate(completions)]
+        completion_tokens = sum(estimate_tokens(c) for c in completions)
+        self._send(200, {
+            "id": f"mock-{ReplayStore.key(prompt)[:12]}",
+            "object": "chat.completion" if chat else "text_completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'mock'),
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    args = parse_args()
+    MockHandler.store = ReplayStore(args.replay_file)
+    MockHandler.latency = LatencyModel(args.latency)
+    MockHandler.error_rate = args.error_rate
+    MockHandler.rng = random.Random(args.seed)
+    if args.rpm:
+        MockHandler.requests = TokenBucket(args.rpm / 60, max(1., args.rpm / 60))
+    if args.tpm:
+        MockHandler.tokens = TokenBucket(args.tpm / 60, max(1., args.tpm / 60))
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    print(f"Mock LLM server on http://{args.host}:{args.port}/v1 replaying {args.replay_file}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
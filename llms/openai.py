@@ -4,12 +4,14 @@
 # @Email   : httdty2@163.com
 # @File    : openai.py
 # @Software: PyCharm
+import asyncio
 import time
 from concurrent.futures import ThreadPoolExecutor
 from itertools import repeat
 
-from llms.llm import LLM
+from llms.llm import LLM, AsyncLLM, FailedCompletion
 from llms.config import OPENAI_KEY
+from llms.rate_limit import RateLimiter, RetryPolicy
 import openai
 
 openai.api_key = OPENAI_KEY
@@ -20,57 +22,129 @@ class Openai(LLM):
               'gpt-3.5-turbo-0613', 'gpt-3.5-turbo-1106', 'gpt-3.5-turbo-0301',
               'gpt-4-0613', 'gpt-4-0314'}
 
+    chat_models = {'gpt-4', 'gpt-3.5-turbo', 'gpt-3.5-turbo-0613', 'gpt-3.5-turbo-1106',
+                   'gpt-3.5-turbo-0301', 'gpt-4-0613', 'gpt-4-0314'}
+
     def __init__(self, name, interval=0, **kwargs):
         super().__init__(name)
         if 'api_key' in kwargs:
             if kwargs['api_key']:
                 openai.api_key = kwargs['api_key']
-        if self.name in {'gpt-4', 'gpt-3.5-turbo', 'gpt-3.5-turbo-0613', 'gpt-3.5-turbo-1106',
-                         'gpt-3.5-turbo-0301', 'gpt-4-0613', 'gpt-4-0314'}:
+        if kwargs.get('api_base'):
+            openai.api_base = kwargs['api_base']
+        if self.name in self.chat_models:
             self.api = openai.ChatCompletion.create
         elif self.name in {'text-davinci-003'}:
             self.api = openai.Completion.create
         else:
             raise LookupError("Please use valid model name for Openai model")
         self.interval = interval
+        self.cache = kwargs.get('cache')
+        self.limiter = RateLimiter.for_model(self.name, kwargs.get('rpm', 0), kwargs.get('tpm', 0))
+        self.retry = RetryPolicy(max_retries=kwargs.get('max_retries', 8))
+
+    def _request_args(self, prompt, kwargs):
+        if self.name in self.chat_models:
+            return dict(
+                model=self.name,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                # temperature=0,
+                max_tokens=128,
+                # top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0,
+                request_timeout=30,
+                **kwargs
+            )
+        else:
+            return dict(
+                model=self.name,
+                prompt=prompt,
+                # temperature=0,
+                max_tokens=128,
+                # top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0,
+                request_timeout=30,
+                **kwargs
+            )
+
+    def _parse_response(self, response):
+        # Item access works for both API objects and cached plain dicts
+        self.count += 1
+        self.prompt_length += response['usage']['prompt_tokens']
+        self.completion_length += response['usage']['completion_tokens']
+        if response.get('failed'):
+            return [FailedCompletion() for _ in response['choices']]
+        if self.name in self.chat_models:
+            return [choice['message']['content'] for choice in response['choices']]
+        else:
+            return [choice['text'].strip() for choice in response['choices']]
+
+    def _cache_key(self, prompt, request, wave_idx=0):
+        return self.cache.key(
+            self.name, prompt,
+            n=request.get('n'),
+            stop=request.get('stop'),
+            temperature=request.get('temperature'),
+            max_tokens=request.get('max_tokens'),
+            wave_idx=wave_idx,
+        )
+
+    def _estimate_tokens(self, prompt, prompt_tokens, request):
+        if prompt_tokens is None:
+            prompt_tokens = len(prompt) // 4
+        return prompt_tokens + request.get('max_tokens', 0) * (request.get('n') or 1)
+
+    def _failed_response(self):
+        if self.name in self.chat_models:
+            choice = {"message": {"content": ""}}
+        else:
+            choice = {"text": ""}
+        return {"choices": [choice], "usage": {"prompt_tokens": 0, "completion_tokens": 0}, "failed": True}
+
+    def _retry_delay(self, attempt, error):
+        """Seconds to wait before the next attempt, `None` to give up on the request."""
+        print(error)
+        delay = self.retry.delay(attempt, error)
+        if delay is not None and self.retry.is_rate_limit(error):
+            self.limiter.block(delay)
+        return delay
+
+    def _settle(self, estimated, response):
+        usage = response['usage']
+        self.limiter.settle(estimated, usage['prompt_tokens'] + usage['completion_tokens'])
 
-    def __infer_one(self, prompt, kwargs):
+    def __infer_one(self, item, kwargs):
+        prompt, prompt_tokens = self._unpack(item)
+        kwargs = dict(kwargs)
+        wave_idx = kwargs.pop('wave_idx', 0)
+        request = self._request_args(prompt, kwargs)
+        if self.cache:
+            key = self._cache_key(prompt, request, wave_idx)
+            response = self.cache.get(key)
+            if response:
+                return response
+        estimated = self._estimate_tokens(prompt, prompt_tokens, request)
         response = None
+        attempt = 0
         while not response:
+            time.sleep(self.limiter.reserve(estimated))
             try:
-                if self.name in {'gpt-4', 'gpt-3.5-turbo',
-                                 'gpt-3.5-turbo-0613', 'gpt-3.5-turbo-1106', 'gpt-3.5-turbo-0301',
-                                 'gpt-4-0613', 'gpt-4-0314'}:
-                    response = self.api(
-                        model=self.name,
-                        messages=[
-                            {"role": "user", "content": prompt}
-                        ],
-                        # temperature=0,
-                        max_tokens=128,
-                        # top_p=1,
-                        frequency_penalty=0,
-                        presence_penalty=0,
-                        request_timeout=30,
-                        **kwargs
-                    )
-                elif self.name in {'text-davinci-003'}:
-                    response = self.api(
-                        model=self.name,
-                        prompt=prompt,
-                        # temperature=0,
-                        max_tokens=128,
-                        # top_p=1,
-                        frequency_penalty=0,
-                        presence_penalty=0,
-                        request_timeout=30,
-                        **kwargs
-                    )
+                response = self.api(**request)
             except Exception as e:
-                print(e)
-                time.sleep(12)
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    return self._failed_response()
+                time.sleep(delay)
+                attempt += 1
                 response = None
 
+        self._settle(estimated, response)
+        if self.cache:
+            response = self.cache.put(key, self.name, response)
         return response
 
     def infer(self, prompt_list, **kwargs):
@@ -79,19 +153,47 @@ class Openai(LLM):
         with ThreadPoolExecutor(max_workers=min(len(prompt_list), 32)) as pool:
             response_list = pool.map(self.__infer_one, prompt_list, repeat(kwargs))
             for response in response_list:
-                self.count += 1
-                if self.name in {'gpt-4', 'gpt-3.5-turbo',
-                                 'gpt-3.5-turbo-0613', 'gpt-3.5-turbo-1106', 'gpt-3.5-turbo-0301',
-                                 'gpt-4-0613', 'gpt-4-0314'}:
-                    res.append([choice.message.content for choice in response.choices])
-                    self.prompt_length += response.usage.prompt_tokens
-                    self.completion_length += response.usage.completion_tokens
-                elif self.name in {'text-davinci-003'}:
-                    # res.append([choice.message.content for choice in response.choices])
-                    res.append([choice.text.strip() for choice in response.choices])
-                    self.prompt_length += response.usage.prompt_tokens
-                    self.completion_length += response.usage.completion_tokens
-                else:
-                    res.append(response.choices)
+                res.append(self._parse_response(response))
             time.sleep(self.interval)
         return res
+
+
+class AsyncOpenai(Openai, AsyncLLM):
+    """Openai backend keeping `max_in_flight` requests running across the whole input."""
+
+    def __init__(self, name, max_in_flight=32, **kwargs):
+        super().__init__(name, **kwargs)
+        self.max_in_flight = max_in_flight
+        if self.name in self.chat_models:
+            self.aapi = openai.ChatCompletion.acreate
+        else:
+            self.aapi = openai.Completion.acreate
+
+    async def ainfer_one(self, item, **kwargs):
+        prompt, prompt_tokens = self._unpack(item)
+        wave_idx = kwargs.pop('wave_idx', 0)
+        request = self._request_args(prompt, kwargs)
+        if self.cache:
+            key = self._cache_key(prompt, request, wave_idx)
+            response = self.cache.get(key)
+            if response:
+                return self._parse_response(response)
+        estimated = self._estimate_tokens(prompt, prompt_tokens, request)
+        response = None
+        attempt = 0
+        while not response:
+            await asyncio.sleep(self.limiter.reserve(estimated))
+            try:
+                response = await self.aapi(**request)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    return self._parse_response(self._failed_response())
+                await asyncio.sleep(delay)
+                attempt += 1
+                response = None
+
+        self._settle(estimated, response)
+        if self.cache:
+            response = self.cache.put(key, self.name, response)
+        return self._parse_response(response)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 11:20
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : rate_limit.py
+# @Software: PyCharm
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` units per second, holding at most `capacity` units.
+
+    `reserve` never blocks: it takes the units immediately (the level may go negative)
+    and returns how long the caller has to wait before sending, so concurrent callers queue up.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill()
+            # A single request larger than the bucket still has to go through eventually
+            self.level -= min(amount, self.capacity)
+            return 0. if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount: float):
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+    def block(self, seconds: float):
+        with self._lock:
+            self._refill()
+            self.level = min(self.level, -seconds * self.rate)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets, shared by every client of a model."""
+    _shared: Dict[Tuple[str, int, int], "RateLimiter"] = {}
+    _shared_lock = threading.Lock()
+
+    # Burst allowance, in seconds worth of budget
+    burst = 10
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm / 60, max(1., rpm / 60 * self.burst)) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, max(1., tpm / 60 * self.burst)) if tpm else None
+
+    @classmethod
+    def for_model(cls, model_name: str, rpm: int = 0, tpm: int = 0) -> "RateLimiter":
+        key = (model_name, rpm, tpm)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(rpm, tpm)
+            return cls._shared[key]
+
+    def reserve(self, tokens: int) -> float:
+        wait = 0.
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def settle(self, estimated: int, used: int):
+        """Give back the over-estimated part of a reservation once the real usage is known."""
+        if self.tokens and used < estimated:
+            self.tokens.refund(estimated - used)
+
+    def block(self, seconds: float):
+        """Stop every client for `seconds`, e.g. after the provider answered with a rate limit."""
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.block(seconds)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring `Retry-After` and failing fast on invalid requests."""
+    fatal_errors = {
+        'InvalidRequestError', 'AuthenticationError', 'PermissionError',
+        'InvalidAPIType', 'SignatureVerificationError',
+    }
+    rate_limit_errors = {'RateLimitError'}
+
+    def __init__(self, max_retries: int = 8, base: float = 1., cap: float = 60.):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+
+    @staticmethod
+    def _error_names(error: BaseException):
+        return {klass.__name__ for klass in type(error).__mro__}
+
+    def is_fatal(self, error: BaseException) -> bool:
+        return bool(self._error_names(error) & self.fatal_errors)
+
+    def is_rate_limit(self, error: BaseException) -> bool:
+        return bool(self._error_names(error) & self.rate_limit_errors)
+
+    @staticmethod
+    def retry_after(error: BaseException) -> Optional[float]:
+        headers = getattr(error, 'headers', None) or {}
+        for header, scale in (('retry-after-ms', 1e-3), ('retry-after', 1.)):
+            value = headers.get(header) or headers.get(header.title())
+            if value is None:
+                continue
+            try:
+                return float(value) * scale
+            except (TypeError, ValueError):
+                continue
+        return None
+
+    def delay(self, attempt: int, error: BaseException) -> Optional[float]:
+        """Seconds to wait before retry number `attempt + 1`, `None` if the request should be given up."""
+        if self.is_fatal(error) or attempt >= self.max_retries:
+            return None
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
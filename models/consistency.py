@@ -1,18 +1,23 @@
-import asyncio
 import json
 import os
 import random
 import re
 import sqlite3
 import threading
-from collections import defaultdict
+from collections import Counter, defaultdict
+from functools import lru_cache
 from itertools import product
-from typing import Tuple, Any, List, Set
+from typing import Tuple, Any, Dict, List, Optional, Set
 import sqlparse
 import tqdm
 
+from db_exec import connections, decode_ignore, execute
+
 threadLock = threading.Lock()
 TIMEOUT = 60
+# Caps of a candidate result, a larger one is not voted for
+MAX_ROWS = 100000
+MAX_BYTES = 64 << 20
 EXEC_TMP_DIR = os.path.join(os.path.dirname(__file__), "tmp")
 
 
@@ -118,50 +123,37 @@ def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -
     return False
 
 
+def denotation_fingerprint(result: List[Tuple]) -> Tuple:
+    """Hash of a denotation that is the same for any two with `result_eq(r1, r2, False)`.
+
+    Invariant to row and column order: the bag of rows, each as its sorted value hashes, and
+    the sorted hashes of the column bags. Different denotations rarely collide.
+    """
+    if not result:
+        return 0, 0, (), 0
+    rows = Counter(tuple(sorted(map(hash, row))) for row in result)
+    columns = sorted(hash(frozenset(Counter(column).items())) for column in zip(*result))
+    return len(result), len(result[0]), tuple(columns), hash(frozenset(rows.items()))
+
+
 def replace_cur_year(query: str) -> str:
     return re.sub(
         "YEAR\s*\(\s*CURDATE\s*\(\s*\)\s*\)\s*", "2020", query, flags=re.IGNORECASE
     )
 
 
-# get the database cursor for a sqlite database path
-def get_cursor_from_path(sqlite_path: str):
-    try:
-        if not os.path.exists(sqlite_path):
-            print("Openning a new connection %s" % sqlite_path)
-        connection = sqlite3.connect(sqlite_path)
-    except Exception as e:
-        print(sqlite_path)
-        raise e
-    connection.text_factory = lambda b: b.decode(errors="ignore")
-    cursor = connection.cursor()
-    return cursor
-
-
-async def exec_on_db_(sqlite_path: str, query: str) -> Tuple[str, Any]:
+def exec_on_db(
+        sqlite_path: str, query: str, process_id: str = "", timeout: float = TIMEOUT, max_steps: int = 0,
+        max_rows: int = MAX_ROWS, max_bytes: int = MAX_BYTES
+) -> Tuple[str, Any]:
+    """Run the query with a real time budget, a query over it ends as ("exception", ExecTimeout).
+    A result over the caps ends as ("overflow", rows)."""
     query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
     try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
-        return "result", result
+        connection = connections.get(sqlite_path, decode_ignore)
     except Exception as e:
-        cursor.close()
-        cursor.connection.close()
         return "exception", e
-
-
-async def exec_on_db(
-        sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT
-) -> Tuple[str, Any]:
-    try:
-        return await asyncio.wait_for(exec_on_db_(sqlite_path, query), timeout)
-    except asyncio.TimeoutError:
-        return ('exception', TimeoutError)
-    except Exception as e:
-        return ("exception", e)
+    return execute(connection, query, timeout, max_steps, max_rows, max_bytes)
 
 
 # postprocess the model predictions to avoid execution errors
@@ -174,66 +166,130 @@ def remove_distinct(s):
     toks = [t.value for t in list(sqlparse.parse(s)[0].flatten())]
     return "".join([t for t in toks if t.lower() != "distinct"])
 
-def get_exec_output(
-        db: str,
-        sql: str,
-        plug_value: bool = False,
-        keep_distinct: bool = False,
-        progress_bar_for_each_datapoint: bool = False,
-):
+
+@lru_cache(maxsize=8192)
+def normalize_sql(sql: str, keep_distinct: bool = False) -> Optional[str]:
+    """The query as executed, None if sqlparse can not parse it. Samples with the same form share a denotation."""
     # post-process the prediction.
     # e.g. removing spaces between ">" and "="
     sql = postprocess(sql)
-
     if not keep_distinct:
         try:
             # if sqlparse can't parse p_str, we should not even try to execute it
             sql = remove_distinct(sql)
         except Exception as e:
-            return "exception", []
+            return None
+    return sql
 
+
+@lru_cache(maxsize=None)
+def resolve_db_path(db: str) -> Optional[str]:
+    """The sqlite file of `db`, i.e. the first one in its directory."""
     db_dir = os.path.dirname(db)
     db_paths = [os.path.join(db_dir, basename) for basename in os.listdir(db_dir) if ".sqlite" in basename]
-    # print(db_paths)
-    if progress_bar_for_each_datapoint:
-        ranger = tqdm.tqdm(db_paths)
-    else:
-        ranger = db_paths
-    for db_path in ranger:
-        flag, sql_denotation = asyncio.run(exec_on_db(db_path, sql))
-        # print(sql_denotation)
-        return flag, sql_denotation
+    return db_paths[0] if db_paths else None
+
+
+def get_exec_output(
+        db: str,
+        sql: str,
+        plug_value: bool = False,
+        keep_distinct: bool = False,
+        progress_bar_for_each_datapoint: bool = False,
+):
+    sql = normalize_sql(sql, keep_distinct)
+    if sql is None:
+        return "exception", []
+    db_path = resolve_db_path(db)
+    if db_path is None:
+        return None
+    return exec_on_db(db_path, sql)
+
+
+class ConsistencyVoter:
+    """Incremental denotation clustering of the sampled SQL queries of one question."""
+
+    def __init__(self, db_id, db_dir):
+        self.db_path = f"{db_dir}/{db_id}/{db_id}"
+        self.clusters = []
+        self.denotations = []
+        self.first = None
+        self.seen = 0
+        # Cluster of every normalized query executed so far, None if it failed
+        self.executed: Dict[str, Optional[int]] = {}
+        # Clusters by the fingerprint of their denotation, only those are compared with result_eq
+        self.buckets: Dict[Tuple, List[int]] = {}
+
+    def add(self, p_sqls):
+        # Most samples repeat an earlier one, every distinct query runs once and counts as many times as sampled
+        for sql, count in Counter(p_sqls).items():
+            if self.first is None:
+                self.first = sql
+            self.seen += count
+            query = normalize_sql(sql)
+            if query not in self.executed:
+                self.executed[query] = self._cluster(query)
+            idx = self.executed[query]
+            if idx is not None:
+                self.clusters[idx] += [sql] * count
+
+    def _cluster(self, query: Optional[str]) -> Optional[int]:
+        if query is None:
+            return None
+        db_path = resolve_db_path(self.db_path)
+        if db_path is None:
+            return None
+        flag, denotation = exec_on_db(db_path, query)
+        # A failed query or a truncated denotation can not be compared, it gets no votes
+        if flag != "result":
+            return None
+        bucket = self.buckets.setdefault(denotation_fingerprint(denotation), [])
+        for idx in bucket:
+            if result_eq(self.denotations[idx], denotation, False):
+                return idx
+        self.clusters.append([])
+        self.denotations.append(denotation)
+        bucket.append(len(self.clusters) - 1)
+        return len(self.clusters) - 1
+
+    def _leader(self):
+        # The largest cluster, the earliest one on ties
+        return max(range(len(self.clusters)), key=lambda i: (len(self.clusters[i]), -i))
+
+    def best(self):
+        if not self.clusters:
+            return self.first
+        return self.clusters[self._leader()][0]
+
+    def settled(self, remaining: int, confidence: float = 0.) -> bool:
+        """Whether `remaining` more samples can not change `best()`.
+
+        With `confidence`, also stop once the leading cluster holds that share of the samples.
+        """
+        if remaining <= 0:
+            return True
+        if not self.clusters:
+            return False
+        leader = self._leader()
+        lead = len(self.clusters[leader])
+        if confidence and lead / self.seen >= confidence:
+            return True
+        # A new cluster is created after the leader, so it has to get strictly more samples
+        if remaining > lead:
+            return False
+        for idx, cluster in enumerate(self.clusters):
+            if idx == leader:
+                continue
+            reachable = len(cluster) + remaining
+            if reachable > lead or (reachable == lead and idx < leader):
+                return False
+        return True
 
 
 def consistency(p_sqls, db_id, db_dir):
-    db_path = f"{db_dir}/{db_id}/{db_id}"
-    cluster_sql_list = []
-    map_sql2denotation = {}
-    for sql in p_sqls:
-        flag, denotation = get_exec_output(
-            db_path,
-            sql,
-        )
-        if flag == "exception":
-            continue
-        map_sql2denotation[sql] = denotation
-        # print(denotation_match)
-        denotation_match = False
-
-        for idx, cluster in enumerate(cluster_sql_list):
-            center_sql = cluster[0]
-            if result_eq(map_sql2denotation[center_sql], denotation, False):
-                cluster_sql_list[idx].append(sql)
-                denotation_match = True
-                break
-        if not denotation_match:
-            cluster_sql_list.append([sql])
-    cluster_sql_list.sort(key=lambda x: len(x), reverse=True)
-    # print(cluster_sql_list)
-    if not cluster_sql_list:
-        return p_sqls[0]
-    else:
-        return cluster_sql_list[0][0]
+    voter = ConsistencyVoter(db_id, db_dir)
+    voter.add(p_sqls)
+    return voter.best()
 
 #
 # print("save chosen sqls and results...")
@@ -4,34 +4,159 @@
 # @Email   : httdty2@163.com
 # @File    : naive_few_shot.py
 # @Software: PyCharm
-import copy
 import os
 import time
+from collections import Counter
 
 import numpy as np
 import random
 import tiktoken
 
-from functools import lru_cache
-from typing import List, Dict
+from typing import List, Dict, Tuple, Hashable, Sequence, Optional
 
+from models.packing import DemoPacker, Packing
+from models.prompter_bundle import PrompterBundle, bundle_key
 from models.purple_ranker import PurpleRanker
+from models.utils import load_data
 from schema_prune.bridge_content_encoder import get_column_picklist
 
+class PrefixTracker:
+    """Prompts of a run as a trie of their segments, to measure the prefixes they share."""
+
+    def __init__(self):
+        self.nodes: Dict[Tuple[int, Hashable], int] = {}
+
+    def observe(self, segments: Sequence[Hashable]) -> int:
+        """Register a prompt, returning the number of its leading segments sent by an earlier one."""
+        node = 0
+        shared = 0
+        for segment in segments:
+            child = self.nodes.get((node, segment))
+            if child is None:
+                child = len(self.nodes) + 1
+                self.nodes[(node, segment)] = child
+            else:
+                shared += 1
+            node = child
+        return shared
+
+
 class FewShotPrompter:
-    def __init__(self, demonstrations: List, max_length: int = 2048, **kwargs):
-        self.demonstrations = [self._demonstration_init(demo) for demo in demonstrations]
+    layouts = ("default", "prefix")
+    task_desc = "Text2SQL task: Give you database schema and NL question, " \
+                "generate an executable SQL query for me.\n\n"
+
+    def __init__(self, demonstrations: Optional[List], max_length: int = 2048, bundle: PrompterBundle = None,
+                 **kwargs):
         self.max_length = max_length
         self.kwargs = kwargs
         try:
             self.tokenizer = tiktoken.encoding_for_model(self.kwargs.get("model_name", 'gpt-3.5-turbo'))
         except KeyError:
             self.tokenizer = tiktoken.encoding_for_model('gpt-3.5-turbo')
+        if bundle is None:
+            self.demonstrations = [self._demonstration_init(demo) for demo in demonstrations]
+            self.demo_prompts = [demo['prompt'] for demo in self.demonstrations]
+            self.demo_lengths = self._demo_lengths(self.demo_prompts)
+        else:
+            # The demonstrations themselves are not needed once serialized
+            self.demonstrations = None
+            self.demo_prompts = bundle.prompts
+            self.demo_lengths = bundle.lengths
+        # Indices of the demonstrations taken out of the pool, never ranked again
+        self.removed = set()
+        self.task_desc_len = self.get_token_len(self.task_desc)
+        self.packer = DemoPacker(self.kwargs.get("packing", "patience"))
+        self.layout = self.kwargs.get("layout", "default")
+        if self.layout not in self.layouts:
+            raise ValueError(f"Can not handle prompt layout as '{self.layout}'")
+        self._share_rank = None
+        self.prefixes = PrefixTracker()
+
+    @classmethod
+    def from_train_file(cls, train_file: str, cache_dir: str = "", **kwargs):
+        """Prompter over the demonstrations of `train_file`, mapped from its bundle in `cache_dir` if built before."""
+        if not cache_dir:
+            return cls(load_data(train_file), **kwargs)
+        prompter = cls.__new__(cls)
+        prompter.kwargs = kwargs
+        try:
+            tokenizer = tiktoken.encoding_for_model(kwargs.get("model_name", 'gpt-3.5-turbo'))
+        except KeyError:
+            tokenizer = tiktoken.encoding_for_model('gpt-3.5-turbo')
+        key = bundle_key(train_file, cls.__name__, tokenizer.name, prompter._bundle_config())
+        path = os.path.join(cache_dir, f"{cls.__name__}_{key[:16]}")
+        if PrompterBundle.exists(path):
+            return cls.from_bundle(path, **kwargs)
+        prompter.__init__(load_data(train_file), **kwargs)
+        os.makedirs(cache_dir, exist_ok=True)
+        prompter.save(path, key)
+        return prompter
+
+    @classmethod
+    def from_bundle(cls, path: str, **kwargs):
+        """Prompter mapped from the bundle in `path`, e.g. one saved after updating the pool."""
+        prompter = cls.__new__(cls)
+        bundle = PrompterBundle(path)
+        prompter.__init__(None, bundle=bundle, **kwargs)
+        prompter.removed.update(bundle.index["removed"])
+        prompter._load_bundle_index(bundle.index)
+        return prompter
+
+    def save(self, path: str, key: str = "", replace: bool = False):
+        """Store the demonstration pool as a bundle in `path`."""
+        index = {"removed": sorted(self.removed)}
+        index.update(self._bundle_index())
+        PrompterBundle.save(path, key, self.demo_prompts, self.demo_lengths, index, replace=replace)
+
+    def _bundle_config(self) -> List:
+        """Settings besides the train file and tokenizer that change the bundle content."""
+        return []
+
+    def _bundle_index(self) -> Dict:
+        return {}
+
+    def _load_bundle_index(self, index: Dict):
+        pass
+
+    def add_demonstrations(self, demonstrations: List) -> List[int]:
+        """Append demonstrations to the pool, serializing and tokenizing only them. Return their indices."""
+        demonstrations = [self._demonstration_init(demo) for demo in demonstrations]
+        prompts = [demo['prompt'] for demo in demonstrations]
+        start = len(self.demo_prompts)
+        if self.demonstrations is not None:
+            self.demonstrations.extend(demonstrations)
+        # Prompts mapped from a bundle are read-only
+        if not isinstance(self.demo_prompts, list):
+            self.demo_prompts = list(self.demo_prompts)
+        self.demo_prompts.extend(prompts)
+        self.demo_lengths = np.concatenate([self.demo_lengths, self._demo_lengths(prompts)])
+        self._index_demonstrations(demonstrations)
+        self._share_rank = None
+        return list(range(start, len(self.demo_prompts)))
+
+    def remove_demonstrations(self, indices: List[int]):
+        """Take demonstrations out of the pool, the indices of the others are kept."""
+        indices = [i for i in indices if i not in self.removed and 0 <= i < len(self.demo_prompts)]
+        self.removed.update(indices)
+        self._unindex_demonstrations(indices)
+        self._share_rank = None
+
+    def _index_demonstrations(self, demonstrations: List):
+        pass
+
+    def _unindex_demonstrations(self, indices: List[int]):
+        pass
 
-    @lru_cache(maxsize=20000, typed=False)
     def get_token_len(self, input_str: str):
         return len(self.tokenizer.encode(input_str))
 
+    def _demo_lengths(self, prompts: List[str]) -> np.ndarray:
+        """Token number of the demonstrations as placed in a prompt, batch encoded."""
+        texts = [prompt + "\n\n" for prompt in prompts]
+        tokens = self.tokenizer.encode_batch(texts, num_threads=os.cpu_count() or 8)
+        return np.fromiter((len(t) for t in tokens), dtype=np.int32, count=len(texts))
+
     def _demonstration_init(self, demo):
         demo['prompt'] = self._serialize(demo, is_inference=False)
         return demo
@@ -39,44 +164,92 @@ class FewShotPrompter:
     def _serialize(self, ins: Dict, is_inference: bool = True) -> str:
         raise NotImplementedError
 
+    def _serialize_tokens(self, ins: Dict) -> Tuple[str, int]:
+        """Inference prompt of the instance and its token number."""
+        ins_prompt = self._serialize(ins)
+        return ins_prompt, self.get_token_len(ins_prompt)
+
     def get_prompt(self, ins):
+        return self.build_prompt(ins)[0]
+
+    def build_prompt(self, ins, rng: random.Random = None) -> Tuple[str, int]:
+        """Return the prompt and its token number, `rng` drives the random choices of the ranking."""
+        prompt, prompt_tokens, _, _ = self.pack_prompt(ins, rng)
+        return prompt, prompt_tokens
+
+    @property
+    def share_rank(self) -> np.ndarray:
+        """Position of every demonstration when the most widely shared ones come first."""
+        if self._share_rank is None:
+            self._share_rank = self._share_order()
+        return self._share_rank
+
+    def _share_order(self) -> np.ndarray:
+        return np.arange(len(self.demo_prompts))
+
+    def pack_prompts(self, instances: List[Dict], rngs: List[random.Random]) -> List[Tuple[str, int, Packing, int]]:
+        """`pack_prompt` for every instance, ranking their demonstrations together."""
+        rankings = self._ranking_batch(instances, rngs)
+        return [self.pack_prompt(ins, rng, choices) for ins, rng, choices in zip(instances, rngs, rankings)]
+
+    def pack_prompt(self, ins, rng: random.Random = None, choices: List[int] = None) -> Tuple[str, int, Packing, int]:
+        """Return the prompt, its token number, how its demonstrations filled the budget and
+        the number of its leading tokens already sent by an earlier prompt."""
         # Init
-        task_desc = "Text2SQL task: Give you database schema and NL question, " \
-                    "generate an executable SQL query for me.\n\n"
-        ins_prompt = self._serialize(ins)
-        icl_prompt = ""
-        budget = self.max_length - self.get_token_len(ins_prompt) - self.get_token_len(task_desc)
+        ins_prompt, ins_len = self._serialize_tokens(ins)
+        budget = self.max_length - ins_len - self.task_desc_len
 
-        # Ranking demonstrations here
-        choices = self._ranking(ins)
+        # Ranking demonstrations here, unless ranked with others by `pack_prompts`
+        if choices is None:
+            choices = self._ranking(ins, rng or random)
 
         # Budget limit
-        patience = 5
-        while patience > 0:
-            idx = choices.pop(0)
-            demo_prompt = self.demonstrations[idx]['prompt'] + "\n\n"
-            demo_len = self.get_token_len(demo_prompt)
-            if demo_len > budget:
-                patience -= 1
-                continue
-            else:
-                budget -= demo_len
-                # icl_prompt += demo_prompt
-                icl_prompt = demo_prompt + icl_prompt  # reverse ranking
-        return task_desc + icl_prompt + ins_prompt
+        packing = self.packer.pack(choices, self.demo_lengths, budget)
+        if self.layout == "prefix":
+            # Widely shared demonstrations first, so that prompts have long common prefixes
+            demos = sorted(packing.chosen, key=self.share_rank.__getitem__)
+        else:
+            # Reverse ranking, the best demonstration is the closest to the question
+            demos = packing.chosen[::-1]
+        icl_prompt = "".join(self.demo_prompts[idx] + "\n\n" for idx in demos)
 
-    def _ranking(self, ins) -> List[int]:
+        # Prefix reuse, every prompt starts with the task description
+        shared = self.prefixes.observe([-1] + demos)
+        prefix_tokens = self.task_desc_len + int(self.demo_lengths[demos[:shared - 1]].sum()) if shared else 0
+        prompt_tokens = self.max_length - budget + packing.used
+        return self.task_desc + icl_prompt + ins_prompt, prompt_tokens, packing, prefix_tokens
+
+    def _ranking(self, ins, rng: random.Random) -> List[int]:
         raise NotImplementedError
 
+    def _ranking_batch(self, instances: List[Dict], rngs: List[random.Random]) -> List[List[int]]:
+        return [self._ranking(ins, rng) for ins, rng in zip(instances, rngs)]
+
 
 class RandomFewShotPrompter(FewShotPrompter):
-    def __init__(self, demonstrations: List, **kwargs):
+    def __init__(self, demonstrations: Optional[List], **kwargs):
         self.db_dir = kwargs['db_dir']
+        # Sampled values of the columns, keyed by (db_id, table, column)
+        self.picklists: Dict[Tuple[str, str, str], List] = {}
         super().__init__(demonstrations, **kwargs)
 
-    def _serialize(self, ins: Dict, is_inference: bool = True):
-        db_path = os.path.join(self.db_dir, ins['db_id'], f"{ins['db_id']}.sqlite")
+    def _bundle_config(self) -> List:
+        return [os.path.abspath(self.kwargs['db_dir'])]
+
+    def _bundle_index(self) -> Dict:
+        return {"picklists": self.picklists}
 
+    def _load_bundle_index(self, index: Dict):
+        self.picklists.update(index["picklists"])
+
+    def _picklist(self, db_id: str, table_name: str, column_name: str) -> List:
+        key = (db_id, table_name, column_name)
+        if key not in self.picklists:
+            db_path = os.path.join(self.db_dir, db_id, f"{db_id}.sqlite")
+            self.picklists[key] = get_column_picklist(table_name=table_name, column_name=column_name, db_path=db_path)
+        return self.picklists[key]
+
+    def _serialize(self, ins: Dict, is_inference: bool = True):
         # DB info
         table_lines = []
         for table in ins['db_schema']:
@@ -85,9 +258,7 @@ class RandomFewShotPrompter(FewShotPrompter):
             for c_idx, column in enumerate(table['column_names_original']):
                 db_contents = table['db_contents'][c_idx]
                 if len(db_contents) < 3:
-                    vals = get_column_picklist(
-                        table_name=table['table_name_original'], column_name=column, db_path=db_path
-                    )
+                    vals = self._picklist(ins['db_id'], table['table_name_original'], column)
                     db_contents += vals
                 table_line += f"{column}: {' , '.join([str(v) for v in db_contents[:3]])}\n"
             table_lines.append(table_line)
@@ -110,55 +281,108 @@ class RandomFewShotPrompter(FewShotPrompter):
         prompt = f"{db_info}\n{nl_info}\n{answer_info}"
         return prompt
 
-    def _ranking(self, ins) -> List[int]:
-        idx_list = list(range(len(self.demonstrations)))
-        random.shuffle(idx_list)
+    def _ranking(self, ins, rng: random.Random) -> List[int]:
+        idx_list = [i for i in range(len(self.demo_prompts)) if i not in self.removed]
+        rng.shuffle(idx_list)
         return idx_list
 
 
 class PurpleFewShotPrompter(FewShotPrompter):
-    def __init__(self, demonstrations: List, **kwargs):
+    def __init__(self, demonstrations: Optional[List], **kwargs):
         self.enable_domain = kwargs.pop("enable_domain")
         self.enable_skeleton = kwargs.pop("enable_skeleton")
         self.enable_distinct = kwargs.pop("enable_distinct")
+        self.schema_blocks: Dict[Tuple, Tuple[str, int]] = {}
         super().__init__(demonstrations, **kwargs)
-        self.purple_ranker = PurpleRanker(self.demonstrations)
+        self.purple_ranker = PurpleRanker(self.demonstrations) if self.demonstrations is not None else None
+
+    def _bundle_index(self) -> Dict:
+        return {"ranker": self.purple_ranker}
+
+    def _load_bundle_index(self, index: Dict):
+        self.purple_ranker = index["ranker"]
+
+    def _index_demonstrations(self, demonstrations: List):
+        self.purple_ranker.add_demonstrations([demo['sql_skeleton'] for demo in demonstrations])
+
+    def _unindex_demonstrations(self, indices: List[int]):
+        self.purple_ranker.remove_demonstrations(indices)
+
+    def _share_order(self) -> np.ndarray:
+        # Demonstrations of the most common skeletons are picked by the most questions, keep clusters together
+        skeletons = [self.purple_ranker._abs_3(skeleton) for skeleton in self.purple_ranker.skeletons]
+        sizes = Counter(skeleton for i, skeleton in enumerate(skeletons) if i not in self.removed)
+        order = sorted(range(len(skeletons)), key=lambda i: (-sizes[skeletons[i]], skeletons[i], i))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return rank
+
+    def _schema_block(self, ins: Dict, is_inference: bool = True) -> Tuple[str, int]:
+        """Serialized schema of the instance and its token number, cached by the fingerprint of what is shown."""
+        shown = 3 if is_inference else 2
+        tables = tuple(
+            (
+                table['table_name_original'],
+                tuple(table['column_names_original']),
+                tuple(tuple(str(v) for v in db_contents[:shown]) for db_contents in table['db_contents'])
+            )
+            for table in ins['db_schema']
+        )
+        fks = tuple(
+            (fk['source_table_name_original'], fk['source_column_name_original'],
+             fk['target_table_name_original'], fk['target_column_name_original'])
+            for fk in ins['fk']
+        )
+        key = (ins['db_id'], tables, fks)
+        block = self.schema_blocks.get(key)
+        if block is not None:
+            return block
 
-    def _serialize(self, ins: Dict, is_inference: bool = True):
         # DB info
         table_lines = []
-        tables = copy.deepcopy(ins['db_schema'])
         # random.shuffle(tables)
-        for table in tables:
-            table_line = f"Here are some typical values for each column in table '{table['table_name_original']}':\n" \
-                         f"Table: {table['table_name_original']}\n"
-            for c_idx, column in enumerate(table['column_names_original']):
-                db_contents = table['db_contents'][c_idx]
-                if is_inference:
-                    table_line += f"{column}: {' , '.join([str(v) for v in db_contents[:3]])}\n"
-                else:
-                    table_line += f"{column}: {' , '.join([str(v) for v in db_contents[:2]])}\n"
+        for table_name, columns, contents in tables:
+            table_line = f"Here are some typical values for each column in table '{table_name}':\n" \
+                         f"Table: {table_name}\n"
+            for column, values in zip(columns, contents):
+                table_line += f"{column}: {' , '.join(values)}\n"
             table_lines.append(table_line)
-        if len(ins['fk']) > 0:
+        if len(fks) > 0:
             fk_line = "The foreign keys:\n"
-            for fk in ins['fk']:
-                line = f"{fk['source_table_name_original']}.{fk['source_column_name_original']} = " \
-                       f"{fk['target_table_name_original']}.{fk['target_column_name_original']}\n"
-                fk_line += line
+            for source_table, source_column, target_table, target_column in fks:
+                fk_line += f"{source_table}.{source_column} = {target_table}.{target_column}\n"
             table_lines.append(fk_line)
         db_info = '\n'.join(table_lines)
-        db_info = f"'''\n{db_info}'''"
+        # Ending with a newline, the block is never merged with the following tokens
+        db_info = f"'''\n{db_info}'''\n"
+        block = (db_info, self.get_token_len(db_info))
+        self.schema_blocks[key] = block
+        return block
+
+    @staticmethod
+    def _question(ins: Dict, is_inference: bool = True) -> str:
         nl_info = f"The question is '{ins['question']}';"
         if is_inference:
             answer_info = "The SQL query is: "
         else:
             answer_info = f"The SQL query is: {ins['sql']};"  # Format the SQL
-        prompt = f"{db_info}\n{nl_info}\n{answer_info}"
-        return prompt
+        return f"{nl_info}\n{answer_info}"
+
+    def _serialize(self, ins: Dict, is_inference: bool = True):
+        return self._schema_block(ins, is_inference)[0] + self._question(ins, is_inference)
+
+    def _serialize_tokens(self, ins: Dict) -> Tuple[str, int]:
+        block, block_len = self._schema_block(ins)
+        question = self._question(ins)
+        return block + question, block_len + self.get_token_len(question)
+
+    def _ranking_batch(self, instances: List[Dict], rngs: List[random.Random]) -> List[List[int]]:
+        # Instances sharing a predicted skeleton search the tries once
+        return self.purple_ranker.demo_rank_batch(instances, rngs)
 
-    def _ranking(self, ins) -> List[int]:
+    def _ranking(self, ins, rng: random.Random) -> List[int]:
 
-        res = self.purple_ranker.demo_rank(dev_ins=ins)
+        res = self.purple_ranker.demo_rank(dev_ins=ins, rng=rng)
 
         # ins_sql_skeletons = ins['sql_skeleton']
         # structures = [keyword_extract(s['generated_text'].split()) for s in ins_sql_skeletons]
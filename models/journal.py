@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 15:10
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : journal.py
+# @Software: PyCharm
+import hashlib
+import json
+import os
+from typing import Dict, Tuple
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class RunJournal:
+    """Append-only JSONL journal with one record per finished instance of a `models.run` experiment.
+
+    Every record is flushed and fsync-ed when written, so a killed run loses at most the
+    instance being written. A torn last line is dropped when the journal is loaded. Records
+    are `failed` when the LLM gave up on a request, a resumed run runs them again.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.records: Dict[int, Dict] = {}
+        if resume and os.path.exists(path):
+            self.records, valid_size = self._read(path)
+            # Drop the torn tail of a crashed write before appending again
+            if valid_size < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_size)
+            self.file = open(path, 'a')
+        else:
+            self.file = open(path, 'w')
+
+    @staticmethod
+    def _read(path: str) -> Tuple[Dict[int, Dict], int]:
+        records = {}
+        valid_size = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records[record['idx']] = record
+                valid_size += len(line)
+        return records, valid_size
+
+    @classmethod
+    def read(cls, path: str) -> Dict[int, Dict]:
+        """Finished records of a journal, keyed by instance index."""
+        return cls._read(path)[0]
+
+    def append(self, idx: int, prompt: str, raw_result, result: str, mark: Dict, failed: bool = False):
+        record = {
+            "idx": idx,
+            "prompt_hash": prompt_hash(prompt),
+            "prompt": prompt,
+            "raw_result": raw_result,
+            "result": result,
+            "mark": mark,
+            "failed": failed,
+        }
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records[idx] = record
+        return record
+
+    def close(self):
+        self.file.close()
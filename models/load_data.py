@@ -5,8 +5,8 @@
 # @File    : load_data.py
 # @Software: PyCharm
 import json
-
-from tqdm import tqdm
+import random
+from typing import Callable, Dict, Iterable, Iterator, List
 
 from models.few_shot import RandomFewShotPrompter, PurpleFewShotPrompter
 # from models.naive_few_shot import get_few_shot
@@ -21,6 +21,36 @@ def data(args):
     return load_data_strategies[args.data](args)
 
 
+def in_shard(idx, args):
+    return idx % args.num_shards == args.shard_id
+
+
+class InstanceStream:
+    """Instances of the dev set, their prompts being built only when iterated.
+
+    `indices` are the positions in the dev set kept by the run, e.g. the instances of a shard.
+    `build` makes the instances of `chunk_size` positions at a time.
+    """
+
+    def __init__(self, dev: List, build: Callable[[List[int], List[Dict]], List[Dict]], indices: List[int],
+                 chunk_size: int = 16):
+        self.dev = dev
+        self.build = build
+        self.indices = indices
+        self.chunk_size = chunk_size
+
+    def select(self, indices: Iterable[int]) -> 'InstanceStream':
+        return InstanceStream(self.dev, self.build, list(indices), self.chunk_size)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for start in range(0, len(self.indices), self.chunk_size):
+            chunk = self.indices[start:start + self.chunk_size]
+            yield from self.build(chunk, [self.dev[idx] for idx in chunk])
+
+
 def load_data_default(args):
     dev = load_data(args.dev_file)
     # dev = load_data(args.dev_file)[:9]
@@ -48,18 +78,19 @@ def load_ori_data(args):
 def load_zero_shot(dev, args):
     schema = load_schema(args.table_file, args.db_dir)
 
-    instances = []
-    for instance in dev:
-        prompt = get_zero_shot(instance, schema, args.prompt)
-        instances.append(
+    def build(indices, instances):
+        return [
             {
-                "prompt": prompt,
+                "idx": idx,
+                "prompt": get_zero_shot(instance, schema, args.prompt),
                 "gold": instance["query"],
                 "db_id": instance["db_id"],
                 "instance": instance
             }
-        )
-    return instances
+            for idx, instance in zip(indices, instances)
+        ]
+
+    return InstanceStream(dev, build, [idx for idx in range(len(dev)) if in_shard(idx, args)])
 
 def load_few_shot(dev, args):
     # Preprocess dev set
@@ -74,39 +105,46 @@ def load_few_shot(dev, args):
             # ins['sql_skeleton'] = skeleton[0]['generated_text']
             ins['sql_skeleton'] = skeleton
 
-    # Init prompter
-    demonstrations = load_data(args.train_file)
-    prompter = None
+    # Init prompter, mapped from its bundle when --prompter_cache_dir holds one or --prompter_bundle is given
     if args.prompt == 'random':
-        prompter = RandomFewShotPrompter(
-            demonstrations,
-            max_length=args.prompt_length,
-            model_name=args.model_name,
-            db_dir=args.db_dir
-        )
+        prompter_cls = RandomFewShotPrompter
+        kwargs = {"db_dir": args.db_dir}
     elif args.prompt == 'purple':
-        prompter = PurpleFewShotPrompter(
-            demonstrations,
-            max_length=args.prompt_length,
-            model_name=args.model_name,
-            enable_domain=args.enable_domain,
-            enable_skeleton=args.enable_skeleton,
-            enable_distinct=args.enable_distinct,
-        )
-
-    # Prompt gen
-    instances = []
-    print("Prepare prompt for the input...")
-    for idx, instance in tqdm(enumerate(dev)):
-    # for idx, instance in tqdm(enumerate(dev[200:])):
-        prompt = prompter.get_prompt(instance)
-        print(idx)
-        print(prompt)
-        instances.append(
+        prompter_cls = PurpleFewShotPrompter
+        kwargs = {
+            "enable_domain": args.enable_domain,
+            "enable_skeleton": args.enable_skeleton,
+            "enable_distinct": args.enable_distinct,
+        }
+    else:
+        raise ValueError(f"Can not handle prompt as '{args.prompt}'")
+    kwargs.update(
+        max_length=args.prompt_length,
+        model_name=args.model_name,
+        packing=args.packing,
+        layout=args.prompt_layout,
+    )
+    if args.prompter_bundle:
+        prompter = prompter_cls.from_bundle(args.prompter_bundle, **kwargs)
+    else:
+        prompter = prompter_cls.from_train_file(args.train_file, cache_dir=args.prompter_cache_dir, **kwargs)
+
+    # Prompt gen, on demand, the demonstrations of a chunk are ranked in one call
+    def build(indices, instances):
+        # Demonstration shuffles only depend on the instance, a shard builds the same prompts as a full run
+        packed = prompter.pack_prompts(instances, [random.Random(idx) for idx in indices])
+        return [
             {
+                "idx": idx,
                 "prompt": prompt,
+                "prompt_tokens": prompt_tokens,
+                "demo_tokens": packing.used,
+                "wasted_tokens": packing.wasted,
+                "prefix_tokens": prefix_tokens,
                 "gold": instance["sql"],
                 "db_id": instance["db_id"],
             }
-        )
-    return instances
+            for idx, instance, (prompt, prompt_tokens, packing, prefix_tokens) in zip(indices, instances, packed)
+        ]
+
+    return InstanceStream(dev, build, [idx for idx in range(len(dev)) if in_shard(idx, args)])
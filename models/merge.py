@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 17:25
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : merge.py
+# @Software: PyCharm
+import json
+import os
+
+from loguru import logger
+
+from models.journal import RunJournal
+from models.load_data import load_ori_data
+from models.run import parse_args, log_args, output_name
+
+
+def main() -> None:
+    """Merge the shard journals of a sharded `models.run` experiment.
+
+    Takes the same arguments as the sharded runs, e.g. `python -m models.merge ... --num_shards=4`.
+    """
+    args = parse_args()
+    log_args(args)
+
+    # Collect the shards
+    records = {}
+    for shard_id in range(args.num_shards):
+        args.shard_id = shard_id
+        path = os.path.join(args.output_dir, f"{output_name(args)}.jsonl")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Journal of shard {shard_id} not found: {path}")
+        shard = RunJournal.read(path)
+        logger.info(f"Shard {shard_id}: {len(shard)} instances from {path}")
+        records.update(shard)
+
+    total = len(load_ori_data(args))
+    missing = [idx for idx in range(total) if idx not in records]
+    if missing:
+        raise ValueError(f"{len(missing)} instances are not finished yet, e.g. {missing[:10]}, "
+                         f"rerun the shards with --resume")
+    failed = [idx for idx in range(total) if records[idx].get('failed')]
+    if failed:
+        logger.warning(f"The LLM gave up on {len(failed)} instances, e.g. {failed[:10]}, "
+                       f"rerun the shards with --resume to retry them")
+
+    # Merged outputs, in the original order
+    args.num_shards, args.shard_id = 1, 0
+    exp_name = output_name(args)
+    out_log = []
+    with open(os.path.join(args.output_dir, f"{exp_name}.txt"), 'w') as out:
+        for idx in range(total):
+            record = records[idx]
+            out.write(f"{str(record['result'])}\n")
+            out_log.append({k: record[k] for k in ("prompt", "result", "raw_result", "mark")})
+    with open(os.path.join(args.output_dir, f"{exp_name}.json"), 'w') as f:
+        json.dump(out_log, f, indent=4)
+
+    # Stat info
+    em = sum(log['mark']['exact_match'] for log in out_log)
+    ex = sum(log['mark']['exec_match'] for log in out_log)
+    ts = sum(log['mark']['test_suite_match'] for log in out_log)
+    logger.info(
+        f"\nExact match\t{em / total * 100:.2f}%"
+        f"\nExec match \t{ex / total * 100:.2f}%"
+        f"\nTest suite \t{ts / total * 100:.2f}%"
+    )
+    logger.info(f"Exp name: {exp_name}")
+    logger.info(f"Output dir: {args.output_dir}")
+
+    logger.info("Prepare file for eval...")
+    exp_abs = os.path.abspath(os.path.join(args.output_dir, f"{exp_name}.txt"))
+    target_file = os.path.join(os.path.abspath("./"), f"predicted_sql_{args.model_name}.txt")
+    os.system(f"cp {exp_abs} {target_file}")
+    logger.info("Finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 18:30
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : packing.py
+# @Software: PyCharm
+from dataclasses import dataclass
+from typing import List, Sequence
+
+import numpy as np
+
+
+@dataclass
+class Packing:
+    chosen: List[int]  # Demonstration indices, in ranking order
+    used: int  # Tokens of the chosen demonstrations
+    wasted: int  # Budget left unused
+
+
+class DemoPacker:
+    """Fill a token budget with ranked demonstrations.
+
+    Strategies:
+        patience: walk the ranking, skip demonstrations that do not fit and give up after `patience` skips
+        greedy: walk the whole ranking, keeping every demonstration that still fits
+        knapsack: among the `top_k` best ranked, the set maximizing the rank weighted utility sum(1 / (rank + 1))
+    """
+    strategies = ("patience", "greedy", "knapsack")
+
+    def __init__(self, strategy: str = "patience", patience: int = 5, top_k: int = 64):
+        if strategy not in self.strategies:
+            raise ValueError(f"Can not handle packing as '{strategy}'")
+        self.strategy = strategy
+        self.patience = patience
+        self.top_k = top_k
+
+    def pack(self, ranking: Sequence[int], lengths: np.ndarray, budget: int) -> Packing:
+        ranking = np.asarray(ranking, dtype=np.int64)
+        ranked_lengths = lengths[ranking].astype(np.int64)
+        if self.strategy == "patience":
+            picked = self._patience(ranked_lengths, budget)
+        elif self.strategy == "greedy":
+            picked = self._greedy(ranked_lengths, budget)
+        else:
+            picked = self._knapsack(ranked_lengths[:self.top_k], budget)
+        used = int(ranked_lengths[picked].sum())
+        return Packing(ranking[picked].tolist(), used, max(int(budget) - used, 0))
+
+    def _patience(self, ranked_lengths: np.ndarray, budget: int) -> np.ndarray:
+        picked = []
+        patience = self.patience
+        for pos, length in enumerate(ranked_lengths.tolist()):
+            if length > budget:
+                patience -= 1
+                if patience <= 0:
+                    break
+            else:
+                budget -= length
+                picked.append(pos)
+        return np.asarray(picked, dtype=np.int64)
+
+    @staticmethod
+    def _greedy(ranked_lengths: np.ndarray, budget: int) -> np.ndarray:
+        # Jump to the next demonstration that fits, then take the longest run after it that fits as a whole
+        picked = []
+        pos = 0
+        while pos < len(ranked_lengths):
+            fits = np.flatnonzero(ranked_lengths[pos:] <= budget)
+            if not fits.size:
+                break
+            start = pos + int(fits[0])
+            run = np.cumsum(ranked_lengths[start:])
+            end = start + int(np.searchsorted(run, budget, side='right'))
+            picked.append(np.arange(start, end))
+            budget -= int(run[end - start - 1])
+            pos = end
+        return np.concatenate(picked) if picked else np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def _knapsack(ranked_lengths: np.ndarray, budget: int) -> np.ndarray:
+        budget = max(int(budget), 0)
+        weights = 1. / np.arange(1, len(ranked_lengths) + 1)
+        # best[b]: best utility within b tokens, take[i, b]: demonstration i is in that best set
+        best = np.zeros(budget + 1)
+        take = np.zeros((len(ranked_lengths), budget + 1), dtype=bool)
+        for i, (length, weight) in enumerate(zip(ranked_lengths.tolist(), weights)):
+            if length > budget:
+                continue
+            with_i = best[:budget + 1 - length] + weight
+            better = with_i > best[length:]
+            take[i, length:] = better
+            best[length:] = np.where(better, with_i, best[length:])
+        picked = []
+        b = budget
+        for i in range(len(ranked_lengths) - 1, -1, -1):
+            if take[i, b]:
+                picked.append(i)
+                b -= int(ranked_lengths[i])
+        return np.asarray(picked[::-1], dtype=np.int64)
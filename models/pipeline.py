@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 16:40
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : pipeline.py
+# @Software: PyCharm
+import queue
+import threading
+from typing import Dict, Iterable, Optional
+
+from bug_fix.post_fix import BugFix
+from db_exec import enable_replicas
+from models.consistency import ConsistencyVoter, consistency
+from models.utils import clean_output, load_data
+
+
+def bounded_iter(iterable: Iterable, maxsize: int = 64):
+    """Run `iterable` in a producer thread, at most `maxsize` items ahead of the consumer."""
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=producer, name="prompt-builder", daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class OrderedWriter:
+    """Write results line by line in the order of `keys` while they arrive in any order."""
+
+    def __init__(self, out, keys: Iterable):
+        self.out = out
+        self.keys = list(keys)
+        self.lines: Dict = {}
+        self.next = 0
+
+    def put(self, key, line: str):
+        self.lines[key] = line
+        while self.next < len(self.keys) and self.keys[self.next] in self.lines:
+            self.out.write(f"{self.lines.pop(self.keys[self.next])}\n")
+            self.next += 1
+        self.out.flush()
+
+
+def fix_instances(dev_file: str, toy: bool):
+    return load_data(dev_file)[::3] if toy else load_data(dev_file)
+
+
+def post_process(idx, raw_output, bug_fixer: Optional[BugFix] = None):
+    # Out put clean
+    results = clean_output(raw_output)
+    if bug_fixer:
+        for res_idx in range(len(results)):
+            results[res_idx] = bug_fixer.online_fix(idx, results[res_idx])
+    return results
+
+
+def select_sql(idx, db_id, raw_output, db_dir, bug_fixer: Optional[BugFix] = None):
+    results = post_process(idx, raw_output, bug_fixer)
+    if len(results) > 1:
+        return consistency(results, db_id, db_dir)
+    else:
+        return results[0]
+
+
+# Worker process state of the fix/consistency stage
+_worker = {}
+
+
+def init_worker(db_dir: str, dev_file: str, toy: bool, bug_fix: bool, replica_tables: Optional[str] = None):
+    if replica_tables is not None:
+        enable_replicas(replica_tables)
+    _worker['db_dir'] = db_dir
+    _worker['bug_fixer'] = BugFix(db_dir, fix_instances(dev_file, toy)) if bug_fix else None
+
+
+def _fix_counts(bug_fixer: Optional[BugFix]):
+    if bug_fixer:
+        return bug_fixer.fix_pass, bug_fixer.fix_fail, len(bug_fixer.fail_reason)
+    return None
+
+
+def _fixes_since(bug_fixer: Optional[BugFix], counts):
+    if bug_fixer:
+        fix_pass, fix_fail, fail_reason = counts
+        return bug_fixer.fix_pass - fix_pass, bug_fixer.fix_fail - fix_fail, bug_fixer.fail_reason[fail_reason:]
+    return 0, 0, []
+
+
+def select_sql_worker(idx, db_id, raw_output):
+    """Run `select_sql` in a worker process, returning the bug fix counters it added."""
+    bug_fixer = _worker['bug_fixer']
+    counts = _fix_counts(bug_fixer)
+    result = select_sql(idx, db_id, raw_output, _worker['db_dir'], bug_fixer)
+    return result, _fixes_since(bug_fixer, counts)
+
+
+def vote_worker(voter: ConsistencyVoter, idx, raw_output, remaining: int, confidence: float):
+    """Add a wave of samples to `voter` in a worker process.
+
+    The voter travels with the call, so the waves of a question may run in different workers.
+    Returns the voter, whether it is settled and the bug fix counters added.
+    """
+    bug_fixer = _worker['bug_fixer']
+    counts = _fix_counts(bug_fixer)
+    voter.add(post_process(idx, raw_output, bug_fixer))
+    return voter, voter.settled(remaining, confidence), _fixes_since(bug_fixer, counts)
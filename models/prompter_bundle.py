@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 19:20
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : prompter_bundle.py
+# @Software: PyCharm
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+from typing import Any, Sequence
+
+import numpy as np
+
+# Bump when the bundle files change
+BUNDLE_VERSION = 2
+# Modules whose code shapes the bundle content, a change of them invalidates the bundles
+BUNDLE_CODE = ("few_shot.py", "purple_ranker.py", "skeleton_index.py")
+
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def bundle_key(train_file: str, prompter: str, tokenizer: str, config: Sequence = ()) -> str:
+    """Key of the bundle of a prompter over a train file."""
+    sha = hashlib.sha256(json.dumps([BUNDLE_VERSION, prompter, tokenizer, list(config)]).encode("utf-8"))
+    sha.update(file_hash(train_file).encode("utf-8"))
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in BUNDLE_CODE:
+        sha.update(file_hash(os.path.join(code_dir, name)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class PromptTable(Sequence):
+    """Demonstration prompts of a bundle, decoded from the memory-mapped blob on access."""
+
+    def __init__(self, blob_path: str, offsets: np.ndarray):
+        self.offsets = offsets
+        with open(blob_path, 'rb') as f:
+            # mmap refuses empty files
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].decode("utf-8")
+
+
+class PrompterBundle:
+    """Prebuilt state of a few-shot prompter, stored in `path`.
+
+    Files:
+        meta.json: version, key and sizes
+        prompts.bin, offsets.npy: utf-8 demonstration prompts and their boundaries
+        lengths.npy: token numbers of the demonstrations
+        index.pkl: prompter specific state, e.g. the ranker indexes or column samples
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != BUNDLE_VERSION:
+            raise ValueError(f"Bundle {path} has version {self.meta['version']}, expected {BUNDLE_VERSION}")
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        self.prompts = PromptTable(os.path.join(path, "prompts.bin"), offsets)
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode='r')
+        with open(os.path.join(path, "index.pkl"), 'rb') as f:
+            self.index = pickle.load(f)
+
+    @staticmethod
+    def save(path: str, key: str, prompts: Sequence[str], lengths: np.ndarray, index: Any, replace: bool = False):
+        """Write a bundle next to `path` and move it in place, keeping a concurrent writer's bundle
+        unless `replace`."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        encoded = [p.encode("utf-8") for p in prompts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in encoded])
+        with open(os.path.join(tmp, "prompts.bin"), 'wb') as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp, "lengths.npy"), np.asarray(lengths, dtype=np.int32))
+        with open(os.path.join(tmp, "index.pkl"), 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # meta.json last, a bundle without it is incomplete
+        with open(os.path.join(tmp, "meta.json"), 'w') as f:
+            json.dump({"version": BUNDLE_VERSION, "key": key, "size": len(prompts)}, f, indent=4)
+        if replace and os.path.exists(path):
+            # Swap the directories, readers still mapping the old files keep them until closed
+            old = f"{path}.{os.getpid()}.old"
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)
+            return
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train_file", type=str, default="", help="Demonstrations")
+    parser.add_argument("--prompt", type=str, default="purple", choices=["random", "purple"], help="Prompter")
+    parser.add_argument("--model_name", type=str, default="gpt-3.5-turbo", help="Model whose tokenizer counts tokens")
+    parser.add_argument("--db_dir", type=str, default="./datasets/spider/database", help="Databases, for random")
+    parser.add_argument("--cache_dir", type=str, default="", help="Dir of the bundles, i.e. --prompter_cache_dir")
+    parser.add_argument("--bundle", type=str, default="", help="Bundle to update instead of building one")
+    parser.add_argument("--add_file", type=str, default="", help="Demonstrations to add to --bundle")
+    parser.add_argument("--remove", type=str, default="", help="Comma separated demonstration indices to remove")
+    parser.add_argument("--output", type=str, default="",
+                        help="Where the updated bundle goes, run with it by --prompter_bundle")
+
+    args_ = parser.parse_args()
+    if not args_.bundle and not (args_.train_file and args_.cache_dir):
+        parser.error("Either --bundle or both --train_file and --cache_dir are required")
+    if args_.bundle and not args_.output:
+        parser.error("--output is required to update a bundle")
+    return args_
+
+
+def main():
+    """Build the bundle of a prompter ahead of the runs, e.g. before launching a sweep, or update the
+    demonstrations of a bundle."""
+    from models.few_shot import RandomFewShotPrompter, PurpleFewShotPrompter
+    args = parse_args()
+    if args.prompt == 'random':
+        cls, kwargs = RandomFewShotPrompter, {"model_name": args.model_name, "db_dir": args.db_dir}
+    else:
+        cls, kwargs = PurpleFewShotPrompter, {"model_name": args.model_name, "enable_domain": False,
+                                              "enable_skeleton": True, "enable_distinct": False}
+    if not args.bundle:
+        cls.from_train_file(args.train_file, args.cache_dir, **kwargs)
+        print(f"Prompter bundle ready in {args.cache_dir}")
+        return
+
+    prompter = cls.from_bundle(args.bundle, **kwargs)
+    if args.add_file:
+        with open(args.add_file, 'r') as f:
+            added = prompter.add_demonstrations(json.load(f))
+        print(f"Added {len(added)} demonstrations as {added[0] if added else '-'}..{added[-1] if added else '-'}")
+    if args.remove:
+        prompter.remove_demonstrations([int(i) for i in args.remove.split(",")])
+    # No longer the bundle of a train file, not to be found in a cache dir by its key
+    prompter.save(args.output, replace=True)
+    print(f"Prompter bundle {args.output} holds {len(prompter.demo_prompts) - len(prompter.removed)} demonstrations")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,70 @@
 # @Email   : httdty2@163.com
 # @File    : purple_ranker.py
 # @Software: PyCharm
-import copy
 import json
 import random
 # import sqlfluff
-from typing import List
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from anytree import Node
+import numpy as np
 # from sqlfluff.api import APIParsingError
 from tqdm import tqdm
 
+from models.skeleton_index import SkeletonIndex
+
+
+class TrieNode:
+    __slots__ = ('children', 'count', 'ins')
+
+    def __init__(self):
+        self.children: Dict[str, 'TrieNode'] = {}
+        self.count = 0
+        self.ins: Optional[List[int]] = None  # Demonstrations ending here
+
+
+class SkeletonTrie:
+    """Skeleton tokens of one abstraction level as a trie with dict children.
+
+    `ends` maps a whole token sequence straight to its end node, whose `ins` are the
+    demonstrations with exactly that skeleton.
+    """
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.ends: Dict[Tuple[str, ...], TrieNode] = {}
+
+    def insert(self, toks: Sequence[str], idx: int):
+        node = self.root
+        node.count += 1
+        for tok in toks:
+            child = node.children.get(tok)
+            if child is None:
+                child = node.children[tok] = TrieNode()
+            node = child
+            node.count += 1
+        if node.ins is None:
+            node.ins = []
+            self.ends[tuple(toks)] = node
+        node.ins.append(idx)
+
+    def remove(self, toks: Sequence[str], idx: int) -> bool:
+        """Take demonstration `idx` off the skeleton `toks`, returning whether it was there."""
+        node = self.ends.get(tuple(toks))
+        if node is None or idx not in node.ins:
+            return False
+        node.ins.remove(idx)
+        # The nodes stay, an emptied skeleton is found with no demonstrations
+        node = self.root
+        node.count -= 1
+        for tok in toks:
+            node = node.children[tok]
+            node.count -= 1
+        return True
+
+    def search(self, toks: Sequence[str]) -> Optional[TrieNode]:
+        """End node of the skeleton `toks` if some demonstrations have exactly it."""
+        return self.ends.get(tuple(toks))
+
 
 class PurpleRanker:
     all_units = [
@@ -74,16 +128,19 @@ class PurpleRanker:
         'desc': ''
     }
 
-    def __init__(self, demonstrations, levels=None):
+    def __init__(self, demonstrations, levels=None, fallback_k=4):
         if levels is None:
             levels = [0, 1, 2, 3]
         self.demonstrations = demonstrations
+        self.skeletons = [demo['sql_skeleton'] for demo in demonstrations]
+        self.size = len(demonstrations)
+        self.removed = set()
         self.levels = levels
         self.trie = {
-            0: Node("START_0", count=0),
-            1: Node("START_1", count=0),
-            2: Node("START_2", count=0),
-            3: Node("START_3", count=0),
+            0: SkeletonTrie(),
+            1: SkeletonTrie(),
+            2: SkeletonTrie(),
+            3: SkeletonTrie(),
         }
         self.abs_process = {
             0: self._abs_0,
@@ -93,28 +150,55 @@ class PurpleRanker:
         }
         for level in levels:
             self._build_trie(level)
+        # Nearest level 0 skeletons, for predictions without an exact match at any level
+        self.fallback_k = fallback_k
+        self.nearest = None
+        if 0 in levels:
+            self.nearest = SkeletonIndex({toks: node.ins for toks, node in self.trie[0].ends.items()})
 
     def _build_trie(self, level: int):
-        for i, demo in tqdm(enumerate(self.demonstrations), desc=f"Trie build for abs_{level}"):
-            skeleton = self.abs_process[level](demo['sql_skeleton'])  # type: ignore
-            parent = self.trie[level]
-            child = None
-            parent.count += 1  # type: ignore
-            for tok in skeleton.split() + ['END']:
-
-                children = [child.name for child in parent.children]
-                if tok in children:
-                    idx = children.index(tok)
-                    child = parent.children[idx]
-                else:
-                    child = Node(tok, parent=parent, count=0)
-                    if child.name == "END":
-                        child.ins = []
-                parent = child
-                parent.count += 1
-            child.ins.append(i)
-        # from anytree import RenderTree
-        # print(RenderTree(self.trie[level]))
+        trie = self.trie[level]
+        for i, skeleton in tqdm(enumerate(self.skeletons), desc=f"Trie build for abs_{level}"):
+            trie.insert(self.abs_process[level](skeleton).split(), i)  # type: ignore
+
+    def add_demonstrations(self, skeletons: List[str]) -> List[int]:
+        """Index demonstrations with the `skeletons` after the current ones, returning their indices."""
+        start = self.size
+        for i, skeleton in enumerate(skeletons, start):
+            self.skeletons.append(skeleton)
+            for level in self.levels:
+                toks = self.abs_process[level](skeleton).split()  # type: ignore
+                new = tuple(toks) not in self.trie[level].ends
+                self.trie[level].insert(toks, i)
+                if level == 0 and new and self.nearest is not None:
+                    self.nearest.add(tuple(toks), self.trie[0].ends[tuple(toks)].ins)
+        self.size += len(skeletons)
+        return list(range(start, self.size))
+
+    def remove_demonstrations(self, indices: Sequence[int]):
+        """Drop demonstrations from the ranking, the indices of the others are kept."""
+        for i in indices:
+            if i in self.removed or not 0 <= i < self.size:
+                continue
+            for level in self.levels:
+                self.trie[level].remove(self.abs_process[level](self.skeletons[i]).split(), i)  # type: ignore
+            self.removed.add(i)
+
+    def __getstate__(self):
+        # The tries and skeletons are all a ranker needs once built
+        state = self.__dict__.copy()
+        state['demonstrations'] = None
+        state.pop('abs_process')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.abs_process = {
+            0: self._abs_0,
+            1: self._abs_1,
+            2: self._abs_2,
+            3: self._abs_3,
+        }
 
     def _abs_0(self, ori_skeleton):
         sql_skeleton = []
@@ -156,54 +240,60 @@ class PurpleRanker:
             sql_skeleton.append(tok)
         return " ".join(sql_skeleton)
 
-    def trie_search(self, skeleton: str, level: int = 0):
+    def trie_search(self, skeleton: str, level: int = 0) -> Optional[TrieNode]:
         skeleton = self.abs_process[level](skeleton)  # type: ignore
-        return self._sub_tree_search(self.trie[level], skeleton.split() + ['END'])
-
-    def _sub_tree_search(self, sub_tree: Node, toks: List[str]):
-        children = [child.name for child in sub_tree.children]
-        tok = toks.pop(0)
-        if tok in children:
-            child = sub_tree.children[children.index(tok)]
-        else:
-            return None
-
-        if child.name == 'END':
-            return child
-        else:
-            return self._sub_tree_search(child, toks)
-
-    def demo_rank(self, dev_ins, level=4):
+        return self.trie[level].search(skeleton.split())
+
+    def demo_rank(self, dev_ins, level=4, rng: random.Random = None) -> np.ndarray:
+        return self.demo_rank_batch([dev_ins], [rng or random], level)[0]
+
+    def demo_rank_batch(self, dev_instances: List[Dict], rngs: List[random.Random], level=4) -> List[np.ndarray]:
+        """Rank the demonstrations for every instance, with its own random source from `rngs`."""
+        found = {}
+        rankings = []
+        for dev_ins, rng in zip(dev_instances, rngs):
+            ins_sql_skeletons = [s['generated_text'] for s in dev_ins['sql_skeleton']][:4]
+            ins_lists = []
+            for abs_level in range(level):
+                for skeleton in ins_sql_skeletons:
+                    key = (abs_level, skeleton)
+                    if key not in found:
+                        found[key] = self.trie_search(skeleton, abs_level)
+                    # An end node stays once its demonstrations are all removed
+                    if found[key] and found[key].ins:
+                        ins_lists.append(list(found[key].ins))
+            if not ins_lists and self.nearest:
+                queries = [self._abs_0(skeleton).split() for skeleton in ins_sql_skeletons]
+                ins_lists = [list(ins) for ins in self.nearest.search(queries, self.fallback_k)]
+            rankings.append(self._rank(ins_lists, rng))
+        return rankings
+
+    def _rank(self, ins_lists: List[List[int]], rng: random.Random) -> np.ndarray:
         res = []
-        ins_lists = []
-        ins_sql_skeletons = [s['generated_text'] for s in dev_ins['sql_skeleton']][:4]
-
-        for abs_level in range(level):
-            for i, skeleton in enumerate(ins_sql_skeletons):
-                end = self.trie_search(skeleton, abs_level)
-                if end:
-                    ins_lists.append(copy.deepcopy(end.ins))
-
-
+        taken = set()
         priority = 1
         while len(ins_lists) > 0 and len(res) <= 98:
             for candidates in ins_lists[:priority]:
-                random.shuffle(candidates)
                 while candidates:  # based on the count number? or mix together for random?
-                    choice = candidates.pop(0)
-                    if choice not in res and (choice + 1) not in res and (choice - 1) not in res:
+                    # Uniform draw without replacement, swapping the pick to the end to pop it in O(1)
+                    pick = rng.randrange(len(candidates))
+                    candidates[pick], candidates[-1] = candidates[-1], candidates[pick]
+                    choice = candidates.pop()
+                    if choice not in taken and (choice + 1) not in taken and (choice - 1) not in taken:
                         res.append(choice)
+                        taken.add(choice)
                         break
-            for i in range(len(ins_lists) - 1, -1, -1):
-                if len(ins_lists[i]) == 0:
-                    ins_lists.pop(i)
+            ins_lists = [candidates for candidates in ins_lists if candidates]
             priority += 1
 
         # Random for others
-        tail = list(set(list(range(len(self.demonstrations)))) - set(res))
-        random.shuffle(tail)
-        res += tail
-        return res
+        head = np.asarray(res, dtype=np.int64)
+        others = np.ones(self.size, dtype=bool)
+        others[head] = False
+        if self.removed:
+            others[list(self.removed)] = False
+        tail = np.random.default_rng(rng.getrandbits(64)).permutation(np.flatnonzero(others))
+        return np.concatenate([head, tail])
 
 
 def main():
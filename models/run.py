@@ -8,23 +8,29 @@ import os
 import copy
 import json
 import argparse
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-from datasets import Dataset
 from loguru import logger
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from bug_fix.post_fix import BugFix
+from db_exec import enable_replicas
 from eval.spider_evaluator import EvaluateTool
 from llms import model_init
-from models.consistency import consistency
+from llms.llm import has_failed
+from models.consistency import ConsistencyVoter
+from models.journal import RunJournal
 from models.load_data import data, load_ori_data
-from models.utils import clean_output, load_data
+from models.packing import DemoPacker
+from models.pipeline import (bounded_iter, OrderedWriter, fix_instances, post_process, select_sql,
+                             init_worker, select_sql_worker, vote_worker)
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model_name", type=str, required=True, help="Model name")
+    parser.add_argument("--model_name", type=str, required=True, help="Model name, `mock` replays --replay_file")
     parser.add_argument("--gpu", action="store_true", help="Enable gpu")
     parser.add_argument("--toy", action="store_true", help="Toy setting for very few instances")
     parser.add_argument("--exp_name", type=str, default="exp", help="Experiment name")
@@ -83,22 +89,115 @@ def parse_args() -> argparse.Namespace:
                         help="sample_db_dir for test suite")
     parser.add_argument("--bug_fix",
                         action="store_true", help="Enable bug fix for purple")
+    parser.add_argument("--exec_replica",
+                        action="store_true",
+                        help="Execute SQL on in memory copies of the databases, indexed on the key columns "
+                             "of --table_file")
     parser.add_argument("--batch_size",
                         type=int,
                         default=2,
                         help="batch size")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=0,
+                        help="Worker processes for bug fix and consistency, 0 to run them in the main process")
+    parser.add_argument("--max_in_flight",
+                        type=int,
+                        default=0,
+                        help="Number of concurrent LLM requests across the whole set, 0 for batched requests")
+    parser.add_argument("--api_base",
+                        default="",
+                        help="LLMs api base, e.g. a local mock server")
+    parser.add_argument("--replay_file",
+                        type=str,
+                        default="",
+                        help="Recorded run json replayed by the mock model")
+    parser.add_argument("--mock_latency",
+                        type=str,
+                        default="const:0",
+                        help="Latency distribution of the mock model, e.g. const:0.5, uniform:0.2,1.5, exp:0.8")
+    parser.add_argument("--mock_error_rate",
+                        type=float,
+                        default=0.,
+                        help="Rate of injected failures of the mock model")
+    parser.add_argument("--mock_tpm",
+                        type=int,
+                        default=0,
+                        help="Provider side tokens per minute of the mock model, 0 for unlimited")
+    parser.add_argument("--rpm",
+                        type=int,
+                        default=0,
+                        help="Requests per minute budget of the model, 0 for unlimited")
+    parser.add_argument("--tpm",
+                        type=int,
+                        default=0,
+                        help="Tokens per minute budget of the model, 0 for unlimited")
+    parser.add_argument("--max_retries",
+                        type=int,
+                        default=8,
+                        help="Retries of a failed LLM request before giving it up")
+    parser.add_argument("--cache_mode",
+                        choices=["off", "rw", "replay", "write"],
+                        default="off",
+                        help="LLM response cache: read/write through, replay only (fail on miss) or refresh")
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        default="./output/llm_cache",
+                        help="LLM response cache dir")
+    parser.add_argument("--cache_max_mb",
+                        type=int,
+                        default=0,
+                        help="LLM response cache size bound in MB, 0 for unbounded")
     parser.add_argument("--consistency_num",
                         type=int,
                         default=1,
                         help="consistency size")
+    parser.add_argument("--consistency_wave",
+                        type=int,
+                        default=0,
+                        help="Sample consistency_num completions this many at a time and stop early, 0 to disable")
+    parser.add_argument("--consistency_confidence",
+                        type=float,
+                        default=0.,
+                        help="Also stop early once the leading cluster holds this share of the samples, "
+                             "0 to only stop when the selection can not change")
     parser.add_argument("--prompt_length",
                         type=int,
                         default=2048,
                         help="prompt length")
+    parser.add_argument("--prompter_cache_dir",
+                        type=str,
+                        default="",
+                        help="Dir of the prebuilt prompter bundles, built on first use, empty to disable")
+    parser.add_argument("--prompter_bundle",
+                        type=str,
+                        default="",
+                        help="Prompter bundle to run with instead of the --train_file demonstrations, "
+                             "e.g. one updated by models.prompter_bundle --bundle")
+    parser.add_argument("--packing",
+                        type=str,
+                        default="patience",
+                        choices=DemoPacker.strategies,
+                        help="Strategy filling the prompt budget with demonstrations")
+    parser.add_argument("--prompt_layout",
+                        type=str,
+                        default="default",
+                        choices=["default", "prefix"],
+                        help="Demonstration order, prefix puts the most widely shared ones first for prompt caching")
     parser.add_argument("--stage",
                         required=True,
                         choices=["dev", "test"],
                         help="LLMs inference stage")
+    parser.add_argument("--num_shards",
+                        type=int,
+                        default=1,
+                        help="Split the dev set into this many shards by instance index")
+    parser.add_argument("--shard_id",
+                        type=int,
+                        default=0,
+                        help="Shard to run, in [0, num_shards)")
+    parser.add_argument("--resume",
+                        action="store_true", help="Skip the instances already in the run journal")
     parser.add_argument("--api_key",
                         default="",
                         help="LLMs api key")
@@ -108,6 +207,10 @@ def parse_args() -> argparse.Namespace:
     # parser.add_argument("--action_param", action="store_true",
     #                     help="This is an action parameter with action means True")
     args_ = parser.parse_args()
+    if args_.num_shards < 1:
+        parser.error("--num_shards must be at least 1")
+    if not 0 <= args_.shard_id < args_.num_shards:
+        parser.error(f"--shard_id must be in [0, {args_.num_shards})")
     return args_
 
 
@@ -137,6 +240,18 @@ def output_name(args_):
                 name += f"_{k}"
         else:
             name += f"_{k}_{v}"
+    if args_dict['packing'] != "patience":
+        name += f"_packing_{args_dict['packing']}"
+    if args_dict['prompt_layout'] != "default":
+        name += f"_layout_{args_dict['prompt_layout']}"
+    if args_dict['consistency_wave']:
+        name += f"_wave_{args_dict['consistency_wave']}"
+    if args_dict['consistency_confidence']:
+        name += f"_confidence_{args_dict['consistency_confidence']}"
+    if args_dict['prompter_bundle']:
+        name += f"_bundle_{os.path.basename(os.path.normpath(args_dict['prompter_bundle']))}"
+    if args_dict['num_shards'] > 1:
+        name += f"_shard_{args_dict['shard_id']}_of_{args_dict['num_shards']}"
     name = name.replace(os.sep, '_')
     return name
 
@@ -144,7 +259,19 @@ def output_name(args_):
 def model_args(args_):
     return {
         "gpu": args_.gpu,
-        "api_key": args_.api_key
+        "api_key": args_.api_key,
+        "api_base": args_.api_base,
+        "max_in_flight": args_.max_in_flight,
+        "rpm": args_.rpm,
+        "tpm": args_.tpm,
+        "max_retries": args_.max_retries,
+        "cache_mode": args_.cache_mode,
+        "cache_dir": args_.cache_dir,
+        "cache_max_mb": args_.cache_max_mb,
+        "replay_file": args_.replay_file,
+        "latency": args_.mock_latency,
+        "error_rate": args_.mock_error_rate,
+        "provider_tpm": args_.mock_tpm,
     }
 
 
@@ -154,18 +281,20 @@ def main() -> None:
     exp_name = output_name(args)
 
     # Load dev data
-    # dev = Dataset.from_generator(data, gen_kwargs={"args": args})
     dev_data = data(args)
-    dev = Dataset.from_list(dev_data)
-    dev_loader = DataLoader(dev, batch_size=args.batch_size)
 
     # Init model
     model = model_init(args.model_name, **model_args(args))
 
+    # SQL execution of bug fix, consistency and evaluation
+    replica_tables = args.table_file if args.exec_replica else None
+    if replica_tables is not None:
+        enable_replicas(replica_tables)
+
     # Bug fix
     bug_fixer = None
     if args.bug_fix:
-        bug_fixer = BugFix(args.db_dir, load_data(args.dev_file)[::3] if args.toy else load_data(args.dev_file))
+        bug_fixer = BugFix(args.db_dir, fix_instances(args.dev_file, args.toy))
 
     # Exp records
     if args.stage == 'dev':
@@ -175,73 +304,191 @@ def main() -> None:
     else:
         evaluator = None
     out = open(os.path.join(args.output_dir, f"{exp_name}.txt"), 'w')
-    out_log = []
+    # Instances are keyed by their index in the whole dev set, a shard holds a subset of them
+    order = dev_data.indices
+    kept = set(order)
+    writer = OrderedWriter(out, order)
+    out_log = {}
     em = []
     ex = []
     ts = []
+    packed = []
+
+    # Resume from the journal
+    journal = RunJournal(os.path.join(args.output_dir, f"{exp_name}.jsonl"), resume=args.resume)
+    failed = 0
+    for idx, record in journal.records.items():
+        if idx not in kept:
+            continue
+        if record.get('failed'):
+            failed += 1
+            continue
+        out_log[idx] = {k: record[k] for k in ("prompt", "result", "raw_result", "mark")}
+        writer.put(idx, str(record['result']))
+        em.append(record['mark']['exact_match'])
+        ex.append(record['mark']['exec_match'])
+        ts.append(record['mark']['test_suite_match'])
+    if args.resume:
+        logger.info(f"Resume {len(em)} finished instances from {journal.path}, run {failed} failed ones again")
+    pending = dev_data.select(idx for idx in order if idx not in out_log)
+
+    # Prompts are built when the LLM stage pulls them, only the unfinished ones are kept
+    started = {}
+
+    def requests():
+        for pos, ins in enumerate(pending):
+            started[pos] = ins
+            yield ins
+
+    # Fix/consistency stage, executing candidates in worker processes while requests are in flight
+    pool = None
+    if args.workers > 0:
+        # Workers start on the first submit, once the threads of the LLM stage run; forking then could
+        # copy locks those threads hold, so they are started from a clean server process instead
+        methods = multiprocessing.get_all_start_methods()
+        pool = ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn"),
+            initializer=init_worker,
+            initargs=(args.db_dir, args.dev_file, args.toy, args.bug_fix, replica_tables)
+        )
+    selecting = {}
+    # The bug fixer of the main process is not thread-safe, its counters are updated from the LLM threads too
+    fix_lock = threading.Lock()
+
+    def add_fixes(fix_pass, fix_fail, fail_reason):
+        if bug_fixer:
+            with fix_lock:
+                bug_fixer.fix_pass += fix_pass
+                bug_fixer.fix_fail += fix_fail
+                bug_fixer.fail_reason += fail_reason
+
+    # Adaptive consistency: vote after each wave of samples and stop once the selection is settled.
+    # Called from the threads of the LLM stage, the voting runs in the worker processes like `select_sql`
+    voters = {}
+
+    def early_stop(pos, raw_output, remaining):
+        ins = started[pos]
+        voter = voters.get(pos) or ConsistencyVoter(ins['db_id'], args.db_dir)
+        if pool:
+            voter, settled, fixes = pool.submit(
+                vote_worker, voter, ins['idx'], raw_output, remaining, args.consistency_confidence
+            ).result()
+            add_fixes(*fixes)
+        else:
+            # Without workers the waves are voted one at a time, sharing the bug fixer of the main process
+            with fix_lock:
+                voter.add(post_process(ins['idx'], raw_output, bug_fixer))
+            settled = voter.settled(remaining, args.consistency_confidence)
+        voters[pos] = voter
+        return settled
+
+    def finish(ins, raw_output, result):
+        idx = ins['idx']
+        # Eval
+        if evaluator:
+            score = evaluator.evaluate_one(idx=idx, prediction=result)
+        else:
+            score = {
+                'exact_match': 1,
+                'exec_match': 1,
+                'test_suite_match': 1,
+            }
+        em.append(score['exact_match'])
+        ex.append(score['exec_match'])
+        ts.append(score['test_suite_match'])
+        done = len(em)
+        if 'wasted_tokens' in ins:
+            packed.append((ins['demo_tokens'], ins['wasted_tokens'], ins['prefix_tokens'], ins['prompt_tokens']))
+
+        # Log info
+        logger.info(ins['prompt'])
+        logger.info(result)
+        logger.info(ts[-1] != 0)
+        stream.desc = f"EM: {sum(em) / done * 100:.2f}%   " \
+                      f"EX: {sum(ex) / done * 100:.2f}%   " \
+                      f"TS: {sum(ts) / done * 100:.2f}%   " \
+                      f"IN: {model.prompt_length / max(model.count, 1):.1f}   " \
+                      f"OUT: {model.completion_length / max(model.count, 1):.1f} "
+
+        # File log
+        journal.append(idx, ins['prompt'], raw_output, result, score, failed=has_failed(raw_output))
+        out_log[idx] = {
+            "prompt": ins['prompt'],
+            "result": result,
+            "raw_result": raw_output,
+            "mark": score
+        }
+        writer.put(idx, str(result))
 
-    idx = 0
-    batches = tqdm(dev_loader)
-    for batch_ins in batches:
-        batch_raw_output = model.infer(batch_ins['prompt'], stop=";\n", n=args.consistency_num)
-        for i, raw_output in enumerate(batch_raw_output):
-            # Out put clean
-            results = clean_output(raw_output)
-            if bug_fixer:
-                for res_idx in range(len(results)):
-                    results[res_idx] = bug_fixer.online_fix(idx, results[res_idx])
-            if len(results) > 1:
-                result = consistency(results, batch_ins['db_id'][i], args.db_dir)
-            else:
-                result = results[0]
-
-            # Eval
-            if evaluator:
-                score = evaluator.evaluate_one(idx=idx, prediction=result)
-            else:
-                score = {
-                    'exact_match': 1,
-                    'exec_match': 1,
-                    'test_suite_match': 1,
-                }
-            em.append(score['exact_match'])
-            ex.append(score['exec_match'])
-            ts.append(score['test_suite_match'])
-            idx += 1
-
-            # Log info
-            logger.info(batch_ins['prompt'][i])
-            logger.info(result)
-            logger.info(ts[-1] != 0)
-            batches.desc = f"EM: {sum(em) / idx * 100:.2f}%   " \
-                           f"EX: {sum(ex) / idx * 100:.2f}%   " \
-                           f"TS: {sum(ts) / idx * 100:.2f}%   " \
-                           f"IN: {model.prompt_length / model.count:.1f}   " \
-                           f"OUT: {model.completion_length / model.count:.1f} "
-
-            # File log
-            out_log.append({
-                "prompt": batch_ins['prompt'][i],
-                "result": result,
-                "raw_result": raw_output,
-                "mark": score
-            })
-            out.write(f"{str(result)}\n")
-            out.flush()
-    # Stat info
-    if evaluator:
-        evaluator.print_score()
-    logger.info(
-        f"\nExact match\t{sum(em) / idx * 100:.2f}%"
-        f"\nExec match \t{sum(ex) / idx * 100:.2f}%"
-        f"\nTest suite \t{sum(ts) / idx * 100:.2f}%"
-        f"\nPrompt     \t{model.prompt_length / model.count:.1f}"
-        f"\nCompletion \t{model.completion_length / model.count:.1f}"
+    def finish_selected(block: bool):
+        if not selecting:
+            return
+        finished, _ = wait(selecting, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in finished:
+            ins, raw_output = selecting.pop(future)
+            result, fixes = future.result()
+            add_fixes(*fixes)
+            finish(ins, raw_output, result)
+
+    # Stages: prompt build -> LLM -> fix/consistency -> evaluation, results are written in index order
+    stream = tqdm(
+        model.infer_stream(
+            bounded_iter(requests(), maxsize=max(args.max_in_flight, args.batch_size) * 2),
+            batch_size=args.batch_size,
+            wave=args.consistency_wave if args.consistency_num > 1 else 0,
+            early_stop=early_stop,
+            stop=";\n",
+            n=args.consistency_num
+        ),
+        total=len(pending)
     )
+    for pos, raw_output in stream:
+        ins = started.pop(pos)
+        if pos in voters:
+            finish(ins, raw_output, voters.pop(pos).best())
+        elif pool:
+            selecting[pool.submit(select_sql_worker, ins['idx'], ins['db_id'], raw_output)] = (ins, raw_output)
+            # Back-pressure on the LLM stage once every worker has a queue
+            finish_selected(block=len(selecting) >= args.workers * 4)
+        else:
+            with fix_lock:
+                result = select_sql(ins['idx'], ins['db_id'], raw_output, args.db_dir, bug_fixer)
+            finish(ins, raw_output, result)
+    while selecting:
+        finish_selected(block=True)
+    if pool:
+        pool.shutdown()
+    journal.close()
+    out.close()
+
+    # Stat info, a shard may hold no instances at all
+    idx = len(em)
+    if not idx:
+        logger.warning("No instances to score in this run")
+    else:
+        if evaluator:
+            evaluator.print_score()
+        logger.info(
+            f"\nExact match\t{sum(em) / idx * 100:.2f}%"
+            f"\nExec match \t{sum(ex) / idx * 100:.2f}%"
+            f"\nTest suite \t{sum(ts) / idx * 100:.2f}%"
+            f"\nPrompt     \t{model.prompt_length / max(model.count, 1):.1f}"
+            f"\nCompletion \t{model.completion_length / max(model.count, 1):.1f}"
+            f"\nSamples    \t{sum(len(log['raw_result']) for log in out_log.values()) / idx:.1f}"
+        )
+    if packed:
+        used, wasted, prefix, prompt = (sum(p) for p in zip(*packed))
+        logger.info(f"Packing {args.packing}: {used / len(packed):.1f} demonstration tokens, "
+                    f"{wasted / len(packed):.1f} of {args.prompt_length} wasted per prompt")
+        logger.info(f"Layout {args.prompt_layout}: {prefix / max(prompt, 1) * 100:.2f}% of the prompt tokens "
+                    f"in a prefix sent before")
     logger.info(f"Exp name: {exp_name}")
     logger.info(f"Output dir: {args.output_dir}")
     with open(os.path.join(args.output_dir, f"{exp_name}.json"), 'w') as f:
-        json.dump(out_log, f, indent=4)
+        json.dump([out_log[idx] for idx in order], f, indent=4)
+    if getattr(model, 'cache', None):
+        logger.info(f"LLM cache hits: {model.cache.hits}   misses: {model.cache.misses}")
     if bug_fixer:
         logger.info(f"Fix and pass number: {bug_fixer.fix_pass}")
         logger.info(f"Fix but fail number: {bug_fixer.fix_fail}")
@@ -250,8 +497,11 @@ def main() -> None:
 
     logger.info("Prepare file for eval...")
     exp_abs = os.path.abspath(os.path.join(args.output_dir, f"{exp_name}.txt"))
-    target_file = os.path.join(os.path.abspath("./"), f"predicted_sql_{args.model_name}.txt")
-    os.system(f"cp {exp_abs} {target_file}")
+    if args.num_shards > 1:
+        logger.info(f"Shard {args.shard_id} of {args.num_shards} done, merge the shards with models.merge")
+    else:
+        target_file = os.path.join(os.path.abspath("./"), f"predicted_sql_{args.model_name}.txt")
+        os.system(f"cp {exp_abs} {target_file}")
     logger.info("Finished")
 
 
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 20:10
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : skeleton_index.py
+# @Software: PyCharm
+import heapq
+from typing import Dict, List, Sequence, Tuple
+
+
+def token_edit_distance(a: Sequence, b: Sequence) -> int:
+    """Levenshtein distance between two token sequences."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, tok_a in enumerate(a, 1):
+        current = [i]
+        for j, tok_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (tok_a != tok_b)
+            ))
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """BK-tree over token sequences with the token edit distance, for nearest skeleton search."""
+
+    def __init__(self):
+        # Node: (tokens, {distance: child node})
+        self.root = None
+        self.size = 0
+
+    def add(self, toks: Tuple[str, ...]):
+        if self.root is None:
+            self.root = (toks, {})
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            d = token_edit_distance(toks, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (toks, {})
+                self.size += 1
+                return
+            node = child
+
+    def nearest(self, toks: Sequence[str], k: int = 1) -> List[Tuple[int, Tuple[str, ...]]]:
+        """The `k` closest sequences as (distance, tokens), closest first."""
+        if self.root is None or k <= 0:
+            return []
+        best: List[Tuple[int, int, Tuple[str, ...]]] = []  # Max heap of (-distance, -order, tokens)
+        order = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            radius = -best[0][0] if len(best) == k else None
+            d = token_edit_distance(toks, node[0])
+            if radius is None or d < radius:
+                heapq.heappush(best, (-d, -order, node[0]))
+                if len(best) > k:
+                    heapq.heappop(best)
+                radius = -best[0][0] if len(best) == k else None
+            order += 1
+            # Triangle inequality: only children at distance within d +- radius may be closer
+            for child_d, child in node[1].items():
+                if radius is None or abs(child_d - d) <= radius:
+                    stack.append(child)
+        return [(-neg_d, tokens) for neg_d, _, tokens in sorted(best, key=lambda b: (-b[0], -b[1]))]
+
+
+class SkeletonIndex:
+    """Nearest skeletons of the demonstrations, for predictions without an exact match."""
+
+    def __init__(self, skeletons: Dict[Tuple[str, ...], List[int]] = None):
+        self.tree = BKTree()
+        self.ins: Dict[Tuple[str, ...], List[int]] = {}
+        for toks, ins in (skeletons or {}).items():
+            self.add(toks, ins)
+
+    def add(self, toks: Tuple[str, ...], ins: List[int]):
+        self.ins[toks] = ins
+        self.tree.add(toks)
+
+    def search(self, queries: List[Sequence[str]], k: int = 4) -> List[List[int]]:
+        """Demonstrations of the `k` skeletons closest to any of the queries, closest first.
+
+        Skeletons whose demonstrations were all removed are skipped.
+        """
+        width = k
+        while True:
+            found = {}
+            for q_idx, toks in enumerate(queries):
+                for d, skeleton in self.tree.nearest(toks, width):
+                    found[skeleton] = min(found.get(skeleton, (d, q_idx)), (d, q_idx))
+            closest = [skeleton for skeleton in sorted(found, key=found.get) if self.ins[skeleton]]
+            if len(closest) >= k or width >= self.tree.size:
+                return [self.ins[skeleton] for skeleton in closest[:k]]
+            width *= 2
@@ -7,10 +7,11 @@
 import copy
 import json
 import os.path
-import sqlite3
 from typing import Dict, List
 import pickle
 
+from db_exec import connections
+
 
 
 def load_data(data_file: str):
@@ -136,7 +137,7 @@ def db_info_content(schema, db_dir):
     lines = []
     tables = schema['table_names_original']
     db_file = os.path.join(db_dir, schema['db_id'], f"{schema['db_id']}.sqlite")
-    conn = sqlite3.connect(db_file)
+    conn = connections.get(db_file)
     for tab in tables:
         if tab == "sqlite_sequence":
             continue
@@ -13,6 +13,8 @@ from rapidfuzz import fuzz
 import sqlite3
 import functools
 
+from db_exec import connections
+
 # fmt: off
 _stopwords = {'who', 'ourselves', 'down', 'only', 'were', 'him', 'at', "weren't", 'has', 'few', "it's", 'm', 'again',
               'd', 'haven', 'been', 'other', 'we', 'an', 'own', 'doing', 'ma', 'hers', 'all', "haven't", 'in', 'but',
@@ -199,13 +201,13 @@ def get_matched_entries(
 @functools.lru_cache(maxsize=10000, typed=False)
 def get_column_picklist(table_name: str, column_name: str, db_path: str) -> list:
     fetch_sql = "SELECT DISTINCT `{}` FROM `{}`".format(column_name, table_name)
+    c = None
     try:
-        conn = sqlite3.connect(db_path)
-        conn.text_factory = bytes
-        c = conn.cursor()
+        c = connections.get(db_path, bytes).cursor()
         c.execute(fetch_sql)
         picklist = set()
-        for x in c.fetchall():
+        # Iterating the cursor streams the rows, they are never all held next to the picklist
+        for x in c:
             if isinstance(x[0], str):
                 picklist.add(x[0].encode("utf-8"))
             elif isinstance(x[0], bytes):
@@ -221,7 +223,8 @@ def get_column_picklist(table_name: str, column_name: str, db_path: str) -> list
         print("get_column_picklist error", e)
         print(db_path, fetch_sql)
     finally:
-        conn.close()
+        if c is not None:
+            c.close()
     return picklist
 
 
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 10:20
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : test_llm.py
+# @Software: PyCharm
+import asyncio
+
+import pytest
+
+from llms.llm import LLM, AsyncLLM, FailedCompletion, has_failed
+
+
+class FlakyLLM(AsyncLLM):
+    """Echoes its prompts, raising for the prompt `bad`."""
+
+    async def ainfer_one(self, item, **kwargs):
+        await asyncio.sleep(0.01)
+        if item == "bad":
+            raise RuntimeError("request failed")
+        return [item] * (kwargs.get('n') or 1)
+
+
+class GiveUpLLM(AsyncLLM):
+    """Gives up on every request, like a backend out of retries."""
+
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.requests = 0
+
+    async def ainfer_one(self, item, **kwargs):
+        self.requests += 1
+        return [FailedCompletion()]
+
+
+class GiveUpLockstepLLM(LLM):
+    def __init__(self, name):
+        super().__init__(name)
+        self.requests = 0
+
+    def infer(self, prompt_list, **kwargs):
+        self.requests += len(prompt_list)
+        return [[FailedCompletion()] for _ in prompt_list]
+
+
+@pytest.mark.parametrize("max_in_flight", [0, 4])
+def test_stream_yields_every_prompt(max_in_flight):
+    model = FlakyLLM("flaky", max_in_flight=max_in_flight)
+    prompts = [f"p{i}" for i in range(10)]
+    assert dict(model.infer_stream(prompts, batch_size=3)) == {i: [p] for i, p in enumerate(prompts)}
+
+
+@pytest.mark.parametrize("max_in_flight", [0, 4])
+@pytest.mark.parametrize("wave", [0, 2])
+def test_failed_request_fails_stream(max_in_flight, wave):
+    model = FlakyLLM("flaky", max_in_flight=max_in_flight)
+    prompts = ["p0", "p1", "bad"] + [f"p{i}" for i in range(3, 10)]
+    with pytest.raises(RuntimeError, match="request failed"):
+        list(model.infer_stream(prompts, wave=wave, n=4))
+
+
+def test_failed_early_stop_fails_stream():
+    def early_stop(idx, completions, remaining):
+        if idx == 2:
+            raise FileNotFoundError("missing.sqlite")
+        return False
+
+    model = FlakyLLM("flaky", max_in_flight=4)
+    with pytest.raises(FileNotFoundError):
+        list(model.infer_stream([f"p{i}" for i in range(6)], wave=2, early_stop=early_stop, n=4))
+
+
+@pytest.mark.parametrize("model", [GiveUpLLM("give_up", max_in_flight=0), GiveUpLLM("give_up", max_in_flight=4),
+                                   GiveUpLockstepLLM("give_up")])
+def test_failed_wave_stops_sampling(model):
+    outputs = dict(model.infer_stream([f"p{i}" for i in range(3)], wave=5, n=30))
+    assert model.requests == 3
+    assert all(has_failed(completions) for completions in outputs.values())
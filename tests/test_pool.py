@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/19 11:05
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : test_pool.py
+# @Software: PyCharm
+import os
+import signal
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from db_exec import ConnectionManager, ReplicaLoader
+
+
+def make_db(path: str) -> str:
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.executemany("INSERT INTO t VALUES (?, ?)", [(i, f"n{i}") for i in range(10)])
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return make_db(str(tmp_path / "db.sqlite"))
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_fork_while_lock_held(sqlite_path):
+    manager = ConnectionManager()
+    manager.get(sqlite_path)
+    with manager._lock:
+        pid = os.fork()
+        if pid == 0:
+            # A child stuck on the inherited lock is killed by the alarm
+            signal.alarm(10)
+            count = manager.get(sqlite_path).execute("SELECT count(*) FROM t").fetchone()[0]
+            os._exit(0 if count == 10 else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    manager.close_all()
+
+
+def test_replica_loaded_once_per_process(sqlite_path):
+    manager = ConnectionManager(max_open=1)
+    manager.replicas = ReplicaLoader()
+    loads = []
+    load = manager.replicas.load
+    manager.replicas.load = lambda *args: loads.append(args[0]) or load(*args)
+
+    def count():
+        return manager.get(sqlite_path).execute("SELECT count(*) FROM t").fetchone()[0]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(lambda _: count(), range(8))) == [10] * 8
+    # Evicted by another database and opened again
+    other = make_db(sqlite_path + "-other")
+    manager.get(other)
+    assert count() == 10
+    assert loads == [sqlite_path, other]
+
+    connection = manager.get(sqlite_path)
+    for query in ["DELETE FROM t", "DROP TABLE t", "PRAGMA query_only = OFF"]:
+        with pytest.raises(sqlite3.Error):
+            connection.execute(query)
+    assert count() == 10
+    manager.close_all()
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 17:40
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : __init__.py.py
+# @Software: PyCharm
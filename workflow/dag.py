@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 17:40
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : dag.py
+# @Software: PyCharm
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+
+@dataclass
+class Stage:
+    """One step of the pipeline: `python -m module *args`, reading `inputs` and writing `outputs`.
+
+    `code` lists the source files or packages whose change invalidates the outputs.
+    """
+    name: str
+    module: str
+    args: List[str]
+    inputs: List[str]
+    outputs: List[str]
+    code: List[str] = field(default_factory=list)
+
+
+class HashCache:
+    """Content hashes of files, memoized on (size, mtime) so unchanged inputs are not read again."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hashes: Dict[str, List] = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.hashes = json.load(f)
+        self._lock = threading.Lock()
+
+    def file(self, path: str) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            cached = self.hashes.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self.hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def tree(self, path: str) -> Optional[str]:
+        """Hash of a file or a whole directory, None if it does not exist."""
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return None
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                sha.update(os.path.relpath(file_path, path).encode("utf-8"))
+                sha.update(self.file(file_path).encode("utf-8"))
+        return sha.hexdigest()
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.hashes)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+
+class Pipeline:
+    """Stages as a DAG, an edge being an output of one stage read by another.
+
+    Every stage is keyed on the hash of its inputs, code and arguments. The key of the last
+    successful run is stamped in `state_dir`; a stage only reruns when its key changed or one
+    of its outputs is missing or was modified since. Independent stages run in parallel.
+    """
+
+    def __init__(self, stages: List[Stage], state_dir: str = "./.pipeline", workers: int = 1):
+        self.stages = {stage.name: stage for stage in stages}
+        assert len(self.stages) == len(stages), "Stage names must be unique"
+        self.state_dir = state_dir
+        self.workers = max(1, workers)
+        os.makedirs(state_dir, exist_ok=True)
+        self.hashes = HashCache(os.path.join(state_dir, "hashes.json"))
+
+        producer = {}
+        for stage in stages:
+            for output in map(os.path.normpath, stage.outputs):
+                assert output not in producer, f"{output} is written by {producer[output]} and {stage.name}"
+                producer[output] = stage.name
+        self.deps = {
+            stage.name: {producer[os.path.normpath(i)] for i in stage.inputs if os.path.normpath(i) in producer}
+            for stage in stages
+        }
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            assert name not in visiting, f"Cycle through stage {name}"
+            visiting.add(name)
+            for dep in self.deps[name]:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _stamp_path(self, stage: Stage) -> str:
+        return os.path.join(self.state_dir, f"{stage.name}.json")
+
+    def key(self, stage: Stage) -> str:
+        sha = hashlib.sha256()
+        sha.update(json.dumps([stage.module, stage.args]).encode("utf-8"))
+        for path in stage.inputs + stage.code:
+            digest = self.hashes.tree(path)
+            if digest is None:
+                raise FileNotFoundError(f"Input {path} of stage {stage.name} not found")
+            sha.update(f"{path}:{digest}".encode("utf-8"))
+        return sha.hexdigest()
+
+    def is_fresh(self, stage: Stage, key: str) -> bool:
+        stamp_path = self._stamp_path(stage)
+        if not os.path.exists(stamp_path):
+            return False
+        with open(stamp_path, 'r') as f:
+            stamp = json.load(f)
+        if stamp['key'] != key:
+            return False
+        return all(self.hashes.tree(o) == stamp['outputs'].get(o) for o in stage.outputs)
+
+    def run_stage(self, stage: Stage, force: bool = False, dry_run: bool = False) -> bool:
+        """Run the stage if its outputs are stale, returning whether it ran."""
+        key = self.key(stage)
+        if not force and self.is_fresh(stage, key):
+            logger.info(f"{stage.name}: up to date")
+            return False
+        if dry_run:
+            logger.info(f"{stage.name}: would run `python -m {stage.module} {' '.join(stage.args)}`")
+            return True
+        logger.info(f"======================== {stage.name}: start ========================")
+        subprocess.run([sys.executable, "-m", stage.module] + stage.args, check=True)
+        missing = [o for o in stage.outputs if not os.path.exists(o)]
+        if missing:
+            raise RuntimeError(f"Stage {stage.name} did not write {missing}")
+        stamp = {
+            "key": key,
+            "module": stage.module,
+            "args": stage.args,
+            "outputs": {o: self.hashes.tree(o) for o in stage.outputs},
+        }
+        with open(self._stamp_path(stage), 'w') as f:
+            json.dump(stamp, f, indent=4)
+        logger.info(f"======================== {stage.name}: finished ========================")
+        return True
+
+    def run(self, targets: List[str] = None, force: List[str] = (), dry_run: bool = False) -> Dict[str, bool]:
+        """Bring `targets` (all stages by default) and their upstream stages up to date."""
+        todo = set()
+        stack = list(targets or self.stages)
+        while stack:
+            name = stack.pop()
+            if name not in todo:
+                todo.add(name)
+                stack.extend(self.deps[name])
+
+        ran = {}
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while todo or running:
+                    ready = [name for name in todo if self.deps[name].isdisjoint(todo) and
+                             self.deps[name].isdisjoint(running.values())]
+                    for name in sorted(ready):
+                        todo.discard(name)
+                        upstream_ran = any(ran[dep] for dep in self.deps[name])
+                        # A dry run can not tell whether a downstream stage would be stale, assume it is
+                        if dry_run and upstream_ran:
+                            logger.info(f"{name}: would run after its upstream stages")
+                            ran[name] = True
+                            continue
+                        running[pool.submit(self.run_stage, self.stages[name], name in force, dry_run)] = name
+                    if not running:
+                        continue
+                    finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        ran[running.pop(future)] = future.result()
+        finally:
+            self.hashes.save()
+        return ran
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/10/18 17:40
+# @Author  : Ray
+# @Email   : httdty2@163.com
+# @File    : infer.py
+# @Software: PyCharm
+import argparse
+import os
+from typing import List
+
+from loguru import logger
+
+from workflow.dag import Stage, Pipeline
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", type=str, default="spider",
+                        help="Comma separated dataset dirs under --data_dir, each with dev.json, tables.json and "
+                             "database/")
+    parser.add_argument("--data_dir", type=str, default="./datasets", help="Root of the datasets")
+    parser.add_argument("--dev_name", type=str, default="dev", help="Name of the split to prepare")
+    parser.add_argument("--classifier_path", type=str, default="./saved_models/resd_classifier",
+                        help="Schema pruning classifier")
+    parser.add_argument("--skeleton_model", type=str, default="./saved_models/train/tg_3b/BEST_MODEL",
+                        help="Skeleton generation model")
+    parser.add_argument("--state_dir", type=str, default="./.pipeline", help="Stage stamps and hash cache")
+    parser.add_argument("--workers", type=int, default=1, help="Stages running at the same time")
+    parser.add_argument("--targets", type=str, default="",
+                        help="Comma separated stages to bring up to date, all of them by default")
+    parser.add_argument("--force", type=str, default="", help="Comma separated stages to rerun anyway")
+    parser.add_argument("--dry_run", action="store_true", default=False, help="Only report the stale stages")
+
+    args_ = parser.parse_args()
+    return args_
+
+
+def dataset_stages(args, dataset: str) -> List[Stage]:
+    data_dir = os.path.join(args.data_dir, dataset)
+    tables = os.path.join(data_dir, "tables.json")
+    db_dir = os.path.join(data_dir, "database")
+    dev = os.path.join(data_dir, f"{args.dev_name}.json")
+    preprocessed = os.path.join(data_dir, f"{args.dev_name}_preprocessed.json")
+    with_probs = os.path.join(data_dir, f"{args.dev_name}_with_probs.json")
+    pruned = os.path.join(data_dir, f"{args.dev_name}_pruned.json")
+    skeleton = os.path.join(data_dir, f"{args.dev_name}_skeleton.json")
+    return [
+        Stage(
+            name=f"{dataset}_preprocess",
+            module="schema_prune.preprocessing",
+            args=["--mode=test", f"--table_path={tables}", f"--input_file={dev}", f"--db_path={db_dir}",
+                  f"--output_file={preprocessed}"],
+            inputs=[tables, dev, db_dir],
+            outputs=[preprocessed],
+            code=["./schema_prune/preprocessing.py", "./schema_prune/bridge_content_encoder.py"],
+        ),
+        Stage(
+            name=f"{dataset}_classifier",
+            module="schema_prune.classifier",
+            args=["--batch_size", "12", "--seed", "42", "--save_path", args.classifier_path,
+                  "--dev_filepath", preprocessed, "--output_filepath", with_probs, "--mode", "test"],
+            inputs=[preprocessed, args.classifier_path],
+            outputs=[with_probs],
+            code=["./schema_prune/classifier.py", "./schema_prune/classifier_model.py",
+                  "./schema_prune/load_dataset.py"],
+        ),
+        Stage(
+            name=f"{dataset}_postprocess",
+            module="schema_prune.postprocessing",
+            args=[f"--input_file={with_probs}", f"--db_dir={db_dir}", f"--output_file={pruned}"],
+            inputs=[with_probs, db_dir],
+            outputs=[pruned],
+            code=["./schema_prune/postprocessing.py"],
+        ),
+        Stage(
+            name=f"{dataset}_skeleton",
+            module="skeleton.infer",
+            args=["--model_name_or_path", args.skeleton_model, "--source_prefix", "", "--normalize_query",
+                  "--cache_dir", "transformers_cache", "--num_beams", "3", "--num_return_sequences", "3",
+                  "--num_beam_groups", "1", "--overwrite_cache", "--input_file", pruned,
+                  "--output_file", skeleton, "--batch_size", "1"],
+            inputs=[pruned, args.skeleton_model],
+            outputs=[skeleton],
+            code=["./skeleton/infer.py", "./skeleton/utils"],
+        ),
+    ]
+
+
+def main():
+    args = parse_args()
+    stages = []
+    for dataset in args.datasets.split(","):
+        stages += dataset_stages(args, dataset.strip())
+    pipeline = Pipeline(stages, state_dir=args.state_dir, workers=args.workers)
+    ran = pipeline.run(
+        targets=[t for t in args.targets.split(",") if t] or None,
+        force=[f for f in args.force.split(",") if f],
+        dry_run=args.dry_run,
+    )
+    logger.info(f"Stages run: {[name for name, r in ran.items() if r]}")
+
+
+if __name__ == '__main__':
+    main()